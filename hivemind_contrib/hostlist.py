@@ -0,0 +1,227 @@
+"""Compiled hostlist expressions, e.g. qh2-rcc[01-10,13],qh2-rcc99
+
+A HostList is parsed once and then answers membership tests, len() and
+iteration without expanding the bracket ranges into a set of names, so
+expressions covering millions of hosts cost no more than small ones.
+
+This module only depends on the standard library so it can be shared
+with melbourne-tools.
+"""
+
+import bisect
+import itertools
+import re
+
+
+# split on commas which are not inside brackets
+TERM_SPLIT = re.compile(r",\s*(?![^\[\]]*\])")
+GROUP = re.compile(r"\[(.*?)\]")
+
+
+class Group:
+    """The values of a single bracket group, e.g. [01-10,13,a]"""
+
+    def __init__(self, spec):
+        self.literals = set()
+        intervals = []
+        for item in TERM_SPLIT.split(spec):
+            bounds = item.split("-")
+            if len(bounds) == 2 and all(b.isdigit() for b in bounds):
+                # zero padding follows the width of the start of the range
+                width = len(bounds[0])
+                intervals.append((width, int(bounds[0]), int(bounds[1])))
+            else:
+                self.literals.add(item)
+
+        # merge overlapping ranges of the same width
+        self.intervals = []
+        for width, start, end in sorted(intervals):
+            last = self.intervals[-1] if self.intervals else None
+            if last and last[0] == width and start <= last[2] + 1:
+                self.intervals[-1] = (width, last[1], max(last[2], end))
+            else:
+                self.intervals.append((width, start, end))
+        self.keys = [(width, start) for width, start, end in self.intervals]
+        self.pattern = "|".join(
+            [r"\d+"] * bool(self.intervals)
+            + [re.escape(literal) for literal in sorted(self.literals)]
+        )
+
+    def __contains__(self, value):
+        return value in self.literals or self._in_ranges(value)
+
+    def _in_ranges(self, value):
+        if not value.isdigit():
+            return False
+        number = int(value)
+        if value[0] == "0":
+            # zero padded values only belong to ranges of the same width
+            widths = [len(value)]
+        else:
+            # while unpadded ones may belong to ranges with a short start
+            widths = range(1, len(value) + 1)
+        for width in widths:
+            i = bisect.bisect_right(self.keys, (width, number)) - 1
+            if i >= 0:
+                w, start, end = self.intervals[i]
+                if w == width and start <= number <= end:
+                    return True
+        return False
+
+    def __iter__(self):
+        for i, (width, start, end) in enumerate(self.intervals):
+            # ranges of different widths can produce the same value,
+            # e.g. [8-10,08-10], so skip those already produced
+            earlier = [iv for iv in self.intervals[:i] if iv[0] != width]
+            for number in range(start, end + 1):
+                value = str(number).zfill(width)
+                if not any(
+                    s <= number <= e and str(number).zfill(w) == value
+                    for w, s, e in earlier
+                ):
+                    yield value
+        for literal in sorted(self.literals):
+            if not self._in_ranges(literal):
+                yield literal
+
+    def __len__(self):
+        if len({width for width, start, end in self.intervals}) > 1:
+            return sum(1 for _ in self)
+        return sum(end - start + 1 for width, start, end in self.intervals) + (
+            sum(1 for literal in self.literals if not self._in_ranges(literal))
+        )
+
+
+class Term:
+    """A single comma separated term, e.g. qh2-rcc[01-10]-a"""
+
+    def __init__(self, spec):
+        self.literals = GROUP.split(spec)[::2]
+        self.groups = [Group(g) for g in GROUP.findall(spec)]
+        self.regex = re.compile(
+            "".join(
+                re.escape(literal)
+                + (f"({group.pattern})" if group is not None else "")
+                for literal, group in itertools.zip_longest(
+                    self.literals, self.groups
+                )
+            )
+        )
+
+    def __contains__(self, host):
+        # the regex rules most names out, but adjacent groups like
+        # cc[1-2][10-20] can split the digits more than one way
+        if not self.regex.fullmatch(host):
+            return False
+        return self._match(0, host[len(self.literals[0]) :])
+
+    def _match(self, i, rest):
+        """Try each split of rest between the groups from i onwards"""
+        if i == len(self.groups):
+            return not rest
+        literal = self.literals[i + 1]
+        for end in range(len(rest) + 1):
+            if (
+                rest.startswith(literal, end)
+                and rest[:end] in self.groups[i]
+                and self._match(i + 1, rest[end + len(literal) :])
+            ):
+                return True
+        return False
+
+    def __iter__(self):
+        return self._expand(0, self.literals[0])
+
+    def _expand(self, i, prefix):
+        if i == len(self.groups):
+            yield prefix
+            return
+        for value in self.groups[i]:
+            yield from self._expand(
+                i + 1, prefix + value + self.literals[i + 1]
+            )
+
+    def __len__(self):
+        size = 1
+        for group in self.groups:
+            size *= len(group)
+        return size
+
+
+class HostList:
+    """A parsed hostlist expression
+
+    >>> hosts = HostList('qh2-rcc[01-03,10],qh2-rcc99')
+    >>> 'qh2-rcc02' in hosts, 'qh2-rcc2' in hosts
+    (True, False)
+    >>> len(hosts), sorted(hosts)[:2]
+    (5, ['qh2-rcc01', 'qh2-rcc02'])
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.terms = [Term(t) for t in TERM_SPLIT.split(expression) if t]
+
+    def __contains__(self, host):
+        if not isinstance(host, str):
+            return False
+        return any(host in term for term in self.terms)
+
+    def __iter__(self):
+        for i, term in enumerate(self.terms):
+            earlier = self.terms[:i]
+            for host in term:
+                # names also covered by an earlier term are yielded once
+                if not any(host in other for other in earlier):
+                    yield host
+
+    def __len__(self):
+        if len(self.terms) == 1:
+            return len(self.terms[0])
+        return sum(1 for _ in self)
+
+    def __bool__(self):
+        return bool(self.terms)
+
+    def __repr__(self):
+        return f'HostList({self.expression!r})'
+
+
+def compress(hosts):
+    """Return the shortest hostlist expression for the given names
+
+    >>> compress(['cc1', 'cc2', 'cc3', 'cc5', 'cc9', 'db01', 'db02'])
+    'cc[1-3,5,9],db[01-02]'
+    """
+    groups = {}
+    terms = []
+    for host in set(hosts):
+        # the last run of digits is the one which gets compressed
+        match = re.fullmatch(r"(.*?)(\d+)(\D*)", host)
+        if match:
+            prefix, digits, suffix = match.groups()
+            groups.setdefault((prefix, suffix), []).append(digits)
+        else:
+            terms.append(host)
+
+    for (prefix, suffix), values in groups.items():
+        values.sort(key=lambda v: (int(v), len(v)))
+        runs = []
+        for value in values:
+            if runs:
+                first, last = runs[-1]
+                width = len(first)
+                following = str(int(last) + 1).zfill(width)
+                if following == value:
+                    runs[-1] = (first, value)
+                    continue
+            runs.append((value, value))
+        if len(runs) == 1 and runs[0][0] == runs[0][1]:
+            terms.append(f"{prefix}{runs[0][0]}{suffix}")
+            continue
+        ranges = ",".join(
+            first if first == last else f"{first}-{last}"
+            for first, last in runs
+        )
+        terms.append(f"{prefix}[{ranges}]{suffix}")
+    return ",".join(sorted(terms))
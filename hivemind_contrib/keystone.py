@@ -1,8 +1,10 @@
 import collections
+from concurrent import futures
 import csv
 import os
 import random
 import string
+import sys
 
 from fabric.api import task
 from fabric.utils import error
@@ -19,6 +21,16 @@ from hivemind import decorators
 project_cache = {}
 user_cache = {}
 
+# ids already looked for by prefetching, found or not, so ids keystone
+# doesn't know about aren't looked for again in every batch
+project_tried = set()
+user_tried = set()
+
+# above this many uncached ids a single list call is cheaper than many gets
+PREFETCH_LIST_THRESHOLD = 50
+# added to a tried set once its whole list has been fetched
+LISTED = 'listed'
+
 
 @decorators.configurable('nectar.openstack.client')
 def get_session(
@@ -83,9 +95,13 @@ def get_project(keystone, name_or_id, use_cache=False):
             project = projects.find(name=name_or_id)
         finally:
             if project:
-                project_cache.update({project.id: project})
+                # keyed by the name asked for too, so repeat lookups by
+                # name are also answered from the cache
+                project_cache.update(
+                    {project.id: project, name_or_id: project}
+                )
             else:
-                print("Unknown Project")
+                print("Unknown Project", file=sys.stderr)
     return project
 
 
@@ -106,12 +122,52 @@ def get_user(keystone, name_or_id, use_cache=False):
             user = keystone.users.find(name=name_or_id)
         finally:
             if user:
-                user_cache.update({user.id: user})
+                user_cache.update({user.id: user, name_or_id: user})
             else:
-                print("Unknown User")
+                print("Unknown User", file=sys.stderr)
     return user
 
 
+def prefetch_projects(keystone, ids, workers=8):
+    """Fill project_cache with the given project ids in bulk"""
+    _prefetch(
+        get_projects_module(keystone),
+        ids,
+        project_cache,
+        project_tried,
+        workers,
+    )
+
+
+def prefetch_users(keystone, ids, workers=8):
+    """Fill user_cache with the given user ids in bulk"""
+    _prefetch(keystone.users, ids, user_cache, user_tried, workers)
+
+
+def _prefetch(manager, ids, cache, tried, workers):
+    missing = set(ids) - cache.keys() - tried
+    missing.discard(None)
+    if not missing:
+        return
+    tried.update(missing)
+    # the full list only runs once, anything it missed is fetched by id
+    if len(missing) > PREFETCH_LIST_THRESHOLD and LISTED not in tried:
+        tried.add(LISTED)
+        resources = manager.list()
+    else:
+        with futures.ThreadPoolExecutor(max_workers=int(workers)) as pool:
+            resources = list(pool.map(lambda i: _get(manager, i), missing))
+    cache.update({r.id: r for r in resources if r})
+
+
+def _get(manager, resource_id):
+    # ids that can't be found are left for get_project/get_user to report
+    try:
+        return manager.get(resource_id)
+    except NotFound:
+        return None
+
+
 @task
 @decorators.verbose
 def set_vicnode_id(project, vicnode_id):
@@ -1,3 +1,5 @@
+import ipaddress
+
 from neutronclient.neutron import client
 
 from hivemind.decorators import configurable
@@ -8,3 +10,81 @@ from hivemind_contrib import keystone as hv_keystone
 def get_neutron_client(version='2.0'):
     sess = hv_keystone.get_session()
     return client.Client(version, session=sess)
+
+
+# values sent in a single list filter, to keep request URLs short
+FILTER_BATCH = 100
+
+
+def find_device_ids(neutron, addresses=(), networks=()):
+    """Return the IDs of the devices with ports on the given IPs
+
+    Exact addresses are looked up with batched fixed IP and floating IP
+    filters. For networks, only the ports of the subnets overlapping
+    them are listed, and the floating IPs are matched by address, so
+    the cost follows the number of matches rather than the cloud size.
+
+    :param list addresses: ipaddress addresses
+    :param list networks: ipaddress networks
+    """
+    addresses = [str(address) for address in addresses]
+    networks = list(networks)
+
+    def in_networks(address):
+        ip = ipaddress.ip_address(address)
+        return any(ip in network for network in networks)
+
+    ports = []
+    for batch in _batches(addresses):
+        ports += neutron.list_ports(
+            fixed_ips=[f'ip_address={address}' for address in batch]
+        )['ports']
+    if networks:
+        subnets = [
+            subnet['id']
+            for subnet in neutron.list_subnets(fields=['id', 'cidr'])[
+                'subnets'
+            ]
+            if any(
+                network.overlaps(ipaddress.ip_network(subnet['cidr']))
+                for network in networks
+            )
+        ]
+        for batch in _batches(subnets):
+            ports += [
+                port
+                for port in neutron.list_ports(
+                    fixed_ips=[f'subnet_id={subnet}' for subnet in batch]
+                )['ports']
+                if any(
+                    in_networks(ip['ip_address']) for ip in port['fixed_ips']
+                )
+            ]
+
+    floating = []
+    for batch in _batches(addresses):
+        floating += neutron.list_floatingips(floating_ip_address=batch)[
+            'floatingips'
+        ]
+    if networks:
+        floating += [
+            fip
+            for fip in neutron.list_floatingips(
+                fields=['floating_ip_address', 'port_id']
+            )['floatingips']
+            if in_networks(fip['floating_ip_address'])
+        ]
+    port_ids = sorted({fip['port_id'] for fip in floating if fip['port_id']})
+    for batch in _batches(port_ids):
+        ports += neutron.list_ports(id=batch)['ports']
+
+    return {
+        port['device_id']
+        for port in ports
+        if port['device_owner'].startswith('compute:')
+    }
+
+
+def _batches(values):
+    for i in range(0, len(values), FILTER_BATCH):
+        yield values[i : i + FILTER_BATCH]
@@ -236,7 +236,7 @@ def print_dict(dictionary, tofile, ident='', braces=1):
 def _pretty_table_instances(instances):
     header = None
     for inst in instances:
-        if not isinstance(inst, dict):
+        if not isinstance(inst, (dict, nova.ServerInfo)):
             return instances
         else:
             if not header:
@@ -448,6 +448,8 @@ def announcement_mailout(
     smtp_server=None,
     sender=None,
     instances_file=None,
+    max_age=None,
+    use_neutron=False,
     dry_run=True,
 ):
     """Generate mail announcements based on options.
@@ -464,12 +466,20 @@ def announcement_mailout(
        :param str ip: Only consider instances with specific ip addresses
        :param str nodes: Only target instances from the following Hosts/Nodes
        :param str image: Only consider instances with specific image
+       :param str project: Only consider instances of these projects, comma\
+               separated or in a file with one per line
+       :param str user: Only consider instances of these users, comma\
+               separated or in a file with one per line
        :param str status: Only consider instances with status
        :param str subject: Custom email subject
        :param str start_time: Outage start time
        :param float duration: Duration of outage in hours
        :param str timezone: Timezone
        :param str instances_file: Only consider instances listed in file
+       :param int max_age: Use the local instance inventory if it was\
+               refreshed within this many seconds
+       :param boolean use_neutron: Find the instances on ip through their\
+               neutron ports instead of checking every instance
        :param boolean dry_run: By default generate emails without sending out\
                use --no-dry-run to send all notifications
        :param str smtp_server: Specify the SMTP server
@@ -500,6 +510,8 @@ def announcement_mailout(
             user=user,
             status=status,
             image=image,
+            max_age=max_age,
+            use_neutron=use_neutron,
         )
     else:
         inst = get_instances_from_file(nova.client(), instances_file)
@@ -607,6 +619,8 @@ def freshdesk_mailout(
     duration=None,
     timezone="AEDT",
     instances_file=None,
+    max_age=None,
+    use_neutron=False,
     dry_run=True,
     record_metadata=False,
     metadata_field="notification:fd_ticket",
@@ -629,12 +643,20 @@ def freshdesk_mailout(
        :param str ip: Only consider instances with specific ip addresses
        :param str nodes: Only target instances from the following Hosts/Nodes
        :param str image: Only consider instances with specific image
+       :param str project: Only consider instances of these projects, comma\
+               separated or in a file with one per line
+       :param str user: Only consider instances of these users, comma\
+               separated or in a file with one per line
        :param str status: Only consider instances with status
        :param str subject: Custom email subject
        :param str start_time: Outage start time
        :param float duration: duration of outage in hours
        :param str timezone: Timezone
        :param str instances_file: Only consider instances listed in file
+       :param int max_age: Use the local instance inventory if it was\
+               refreshed within this many seconds
+       :param boolean use_neutron: Find the instances on ip through their\
+               neutron ports instead of checking every instance
        :param boolean dry_run: by default print info only, use --no-dry-run\
                for realsies. Log file notify_freshdesk.log will be generated\
                with ticket/emails info during the realsies run.
@@ -676,6 +698,8 @@ def freshdesk_mailout(
                 user=user,
                 status=status,
                 image=image,
+                max_age=max_age,
+                use_neutron=use_neutron,
             )
         else:
             inst = get_instances_from_file(nova.client(), instances_file)
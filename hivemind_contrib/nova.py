@@ -1,32 +1,88 @@
+import bisect
 import collections
+from concurrent import futures
+import contextlib
+import csv
+import datetime
 import dateutil.parser
+import ipaddress
+import itertools
+import json
+import os
 import re
+import sqlite3
 import sys
 import time
 from urllib import parse
 
+from keystoneauth1 import session as ks_session
+from novaclient import api_versions
 from novaclient import client as nova_client
+from novaclient import exceptions as nova_exceptions
+from novaclient.v2 import servers as nova_servers
 
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from fabric.api import task
+from fabric.utils import error
+from fabric.utils import warn
 from prettytable import PrettyTable
+from sqlalchemy import and_
 from sqlalchemy import Column
 from sqlalchemy import create_engine
 from sqlalchemy import DateTime
+from sqlalchemy import desc
+from sqlalchemy import Integer
 from sqlalchemy import MetaData
+from sqlalchemy import or_
+from sqlalchemy.sql import select
 from sqlalchemy import String
 from sqlalchemy import Table
+from sqlalchemy import Text
 
 from hivemind import decorators
 from hivemind.decorators import Spinner
 from hivemind.operations import run
 from hivemind.util import current_host
+from hivemind_contrib import hostlist
 from hivemind_contrib import keystone
-from hivemind_contrib.swift import client as swift_client
+from hivemind_contrib import neutron
+from hivemind_contrib import swift
 
 DEFAULT_AZ = 'melbourne-qh2'
 DEFAULT_SECURITY_GROUPS = 'default,openstack-node,puppet-client'
+# number of concurrent API requests used when fanning out queries
+DEFAULT_WORKERS = 8
+# largest number of alternatives sent to nova in a single filter regex
+MAX_PUSHDOWN_TERMS = 100
+INVENTORY_PATH = '~/.cache/hivemind/nova-inventory.sqlite'
+# seconds to wait for another process's write to the inventory to finish
+INVENTORY_TIMEOUT = 60
+AGGREGATE_INDEX_PATH = '~/.cache/hivemind/nova-aggregates.json'
+# seconds a cached aggregate index is used before fetching a new one
+AGGREGATE_INDEX_TTL = 300
+# seconds to wait for a single scenario check before skipping the server
+SCENARIO_TIMEOUT = 30
+OUTPUT_FORMATS = ('table', 'csv', 'jsonl')
+# largest page size the adaptive paging will ask nova for
+MAX_PAGE_SIZE = 5000
+# attempts at fetching a page before giving up on a server side error
+PAGE_RETRIES = 3
+# microversion which added the changes-before filter used to partition
+# a full scan into time windows
+CHANGES_BEFORE_VERSION = '2.66'
+# the earliest changes-since bound of a partitioned scan
+PARTITION_START = '2010-01-01T00:00:00Z'
+# seconds between the polls of watch_instances
+WATCH_INTERVAL = 10
+WATCH_COLUMNS = ('updated', 'id', 'name', 'status', 'host', 'task_state')
+# seconds boot waits for new servers to get an address
+BOOT_TIMEOUT = 90
+# longest pause between polls while waiting on the API
+MAX_POLL_INTERVAL = 16
+
+# flavor names and IDs to flavor IDs, filled by get_flavor_id
+flavor_cache = {}
 
 FILE_TYPES = {
     'cloud-config': '#cloud-config',
@@ -39,9 +95,59 @@ instances_table = Table(
     'instances',
     metadata,
     Column('created_at', DateTime()),
+    Column('updated_at', DateTime()),
+    Column('deleted', Integer()),
     Column('uuid', String(36)),
+    Column('display_name', String(255)),
     Column('image_ref', String(255)),
+    Column('vm_state', String(255)),
+    Column('host', String(255)),
+    Column('availability_zone', String(255)),
+    Column('project_id', String(255)),
+    Column('user_id', String(255)),
 )
+instance_extra_table = Table(
+    'instance_extra',
+    metadata,
+    Column('instance_uuid', String(36)),
+    Column('deleted', Integer()),
+    Column('flavor', Text()),
+)
+instance_info_caches_table = Table(
+    'instance_info_caches',
+    metadata,
+    Column('instance_uuid', String(36)),
+    Column('deleted', Integer()),
+    Column('network_info', Text()),
+)
+instance_metadata_table = Table(
+    'instance_metadata',
+    metadata,
+    Column('instance_uuid', String(36)),
+    Column('deleted', Integer()),
+    Column('key', String(255)),
+    Column('value', String(255)),
+)
+# API server status for each nova vm_state. Statuses which nova derives
+# from the task state as well, like REBOOT or MIGRATING, are reported
+# under the vm_state's status instead.
+VM_STATES = {
+    'ACTIVE': 'active',
+    'BUILD': 'building',
+    'SHUTOFF': 'stopped',
+    'PAUSED': 'paused',
+    'SUSPENDED': 'suspended',
+    'RESCUE': 'rescued',
+    'VERIFY_RESIZE': 'resized',
+    'SHELVED': 'shelved',
+    'SHELVED_OFFLOADED': 'shelved_offloaded',
+    'SOFT_DELETED': 'soft-delete',
+    'DELETED': 'deleted',
+    'ERROR': 'error',
+}
+VM_STATUSES = {state: status for status, state in VM_STATES.items()}
+# rows fetched from the database cursor at a time
+DB_BATCH_SIZE = 1000
 
 
 @decorators.configurable('connection')
@@ -58,6 +164,68 @@ def client(url=None, username=None, password=None, tenant=None, version='2.1'):
     return nova_client.Client(version, session=sess)
 
 
+def _cloud_settings(
+    url=None, username=None, password=None, tenant=None, region=None
+):
+    return {
+        'auth_url': url,
+        'username': username,
+        'password': password,
+        'tenant_name': tenant,
+        'region': region,
+    }
+
+
+def cloud_clients(profile, version='2.1'):
+    """Return the nova and keystone clients of a cloud profile
+
+    A profile is configured like nectar.openstack.client, in a section
+    named nectar.openstack.client.<profile>, and can also set a region.
+    Any settings a profile leaves out are taken from the default one,
+    and as there the OS_* environment variables take precedence, so
+    with OS_AUTH_URL set every profile authenticates against it.
+    """
+    configured = decorators.configurable(f'nectar.openstack.client.{profile}')
+    settings = {
+        key: value
+        for key, value in configured(_cloud_settings)().items()
+        if value is not None
+    }
+    region = settings.pop('region', None)
+    sess = keystone.get_session(**settings)
+    return (
+        nova_client.Client(version, session=sess, region_name=region),
+        keystone.client(session=sess),
+    )
+
+
+def fan_out(clouds, func, version='2.1'):
+    """Call func(profile, novaclient, ksclient) for each cloud at once
+
+    :param str clouds: Comma separated cloud profile names
+    :returns: (profile, result) pairs in the order the profiles were given
+    """
+    profiles = [profile.strip() for profile in clouds.split(',')]
+    profiles = [profile for profile in profiles if profile]
+    if len(profiles) > 1 and os.environ.get('OS_AUTH_URL'):
+        warn(
+            "OS_AUTH_URL is set and overrides the cloud profiles, "
+            "unset it to reach each cloud's own keystone"
+        )
+
+    def run(profile):
+        return func(profile, *cloud_clients(profile, version))
+
+    with futures.ThreadPoolExecutor(max_workers=len(profiles)) as pool:
+        return list(zip(profiles, pool.map(run, profiles)))
+
+
+def _cloud_path(path, profile):
+    """Return the per cloud version of a cache or checkpoint file path"""
+    base, ext = os.path.splitext(path)
+    return f'{base}.{profile}{ext}'
+
+
 def list_services():
     output = run("nova-manage service list 2>/dev/null")
     services = []
@@ -100,12 +268,85 @@ def enable_host_services(host=None):
         )
 
 
+@task
+@decorators.verbose
+def disable_services(nodes, binary=None, reason=None, workers=DEFAULT_WORKERS):
+    """Disable the nova services of many hosts at once
+
+    :param str nodes: The hosts, using the list syntax
+      (eg. qh2-rcc[01-10,13])
+    :param str binary: Only disable this service, eg. nova-compute
+    :param str reason: Record this reason with the disabled services
+    :param int workers: Number of services to update concurrently
+    """
+    _set_services(nodes, False, binary, reason, int(workers))
+
+
+@task
+@decorators.verbose
+def enable_services(nodes, binary=None, workers=DEFAULT_WORKERS):
+    """Enable the nova services of many hosts at once
+
+    :param str nodes: The hosts, using the list syntax
+      (eg. qh2-rcc[01-10,13])
+    :param str binary: Only enable this service, eg. nova-compute
+    :param int workers: Number of services to update concurrently
+    """
+    _set_services(nodes, True, binary, None, int(workers))
+
+
+def _set_services(nodes, enable, binary, reason, workers):
+    nova = client()
+    hosts = parse_nodes(nodes)
+    services = [
+        service
+        for service in nova.services.list(binary=binary)
+        if service.host in hosts
+    ]
+    if not services:
+        error(f"No services found on {nodes}")
+
+    def update(service):
+        if enable:
+            nova.services.enable(service.host, service.binary)
+        elif reason:
+            nova.services.disable_log_reason(
+                service.host, service.binary, reason
+            )
+        else:
+            nova.services.disable(service.host, service.binary)
+
+    outcomes = []
+    with futures.ThreadPoolExecutor(workers) as executor:
+        jobs = {
+            executor.submit(update, service): service for service in services
+        }
+        for job in futures.as_completed(jobs):
+            service = jobs[job]
+            try:
+                job.result()
+                outcome = 'enabled' if enable else 'disabled'
+            except nova_exceptions.ClientException as e:
+                outcome = f'failed: {e}'
+            outcomes.append((service.host, service.binary, outcome))
+
+    table = PrettyTable(['Host', 'Binary', 'Outcome'])
+    table.align = 'l'
+    for row in sorted(outcomes):
+        table.add_row(row)
+    print(table)
+    return outcomes
+
+
 def get_flavor_id(client, flavor_name):
-    flavors = client.flavors.list()
-    for flavor in flavors:
-        if flavor.name == flavor_name:
-            return flavor.id
-    raise Exception(f"Can't find flavor {flavor_name}")
+    """Get a flavor ID from its name or ID, listing the flavors once"""
+    if flavor_name not in flavor_cache:
+        for flavor in client.flavors.list():
+            flavor_cache[flavor.name] = flavor.id
+            flavor_cache[flavor.id] = flavor.id
+    if flavor_name not in flavor_cache:
+        raise Exception(f"Can't find flavor {flavor_name}")
+    return flavor_cache[flavor_name]
 
 
 def get_flavor(client, flavor_id):
@@ -121,17 +362,26 @@ def get_instance_action(client, instance_id, req_id):
     return client.instance_action.get(instance_id, req_id)
 
 
-def wait_for(func, error_message):
-    for i in range(90):
+def wait_for(func, error_message, timeout=BOOT_TIMEOUT):
+    """Call func until it returns something, doubling the pause each time"""
+    deadline = time.monotonic() + timeout
+    delay = 1
+    while True:
         ret = func()
         if ret:
             return ret
-        time.sleep(1)
-    raise Exception(error_message)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise Exception(error_message)
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, MAX_POLL_INTERVAL)
 
 
 def server_address(client, id):
-    server = client.servers.get(id)
+    return _first_address(client.servers.get(id))
+
+
+def _first_address(server):
     if not server.addresses:
         return None
     for name, addresses in server.addresses.items():
@@ -140,8 +390,42 @@ def server_address(client, id):
                 return address['addr']
 
 
+def wait_for_addresses(client, reservation_id, count, timeout=BOOT_TIMEOUT):
+    """Wait until all servers of a boot request have an address
+
+    All of the servers are polled with one listing per round, and each
+    round only asks for the servers updated since the latest change seen
+    in the previous one.
+
+    :returns: A dict of server ID to (name, address)
+    """
+    addresses = {}
+    opts = {'reservation_id': reservation_id}
+
+    def poll():
+        for server in client.servers.list(search_opts=opts):
+            if server.status == 'ERROR':
+                raise Exception(f"Server {server.name} failed to boot.")
+            address = _first_address(server)
+            if address:
+                addresses[server.id] = (server.name, address)
+            # changes-since also returns servers updated at that instant
+            opts['changes-since'] = max(
+                server.updated, opts.get('changes-since', '')
+            )
+        return len(addresses) >= count
+
+    wait_for(poll, "Servers never got an IP address.", timeout)
+    return addresses
+
+
 @Spinner
-def all_servers(
+def all_servers(client, **kwargs):
+    print("\nListing the instances... ", end="")
+    return list(iter_servers(client, **kwargs))
+
+
+def iter_servers(
     client,
     zone=None,
     host=None,
@@ -152,9 +436,53 @@ def all_servers(
     user=None,
     limit=None,
     changes_since=None,
+    workers=DEFAULT_WORKERS,
+    max_age=None,
+    page_size=None,
+    checkpoint=None,
+    partitions=None,
+    raw=False,
+    db=None,
+    use_neutron=False,
+    inventory_path=INVENTORY_PATH,
+    zone_pushdown=False,
 ):
-    print("\nListing the instances... ", end="")
-    marker = None
+    """Yield the servers matching the search options page by page
+
+    Takes the same arguments as all_servers, but only holds one page of
+    servers at a time so callers can start working on the results while
+    the listing continues.
+
+    If max_age is given the servers are read from the local Inventory
+    at inventory_path instead, after refreshing it if it is more than
+    max_age seconds old.
+
+    page_size sets the number of servers asked for per request, or
+    'auto' to tune it from the time each page takes. If a Checkpoint
+    is given the listing resumes from its marker, and the servers
+    handed on are noted in it so the caller can move the marker on as
+    it writes them out.
+
+    With partitions the listing is split into that many update time
+    windows which are paged concurrently, see _iter_window_pages.
+
+    With raw the servers are read straight from the API's JSON into
+    RawServer records rather than novaclient Server objects. If a nova
+    database connection is given as db they are read from the database
+    instead, see iter_db_servers.
+
+    With use_neutron the instances on the ip addresses are looked up
+    through their neutron ports and fetched by ID, instead of checking
+    the addresses of every server in the cloud.
+
+    With zone_pushdown the zone filter is sent to nova rather than
+    checked here, see _plan_filters for what that misses.
+    """
+    projects = _owner_list(project)
+    users = _owner_list(user)
+    if checkpoint and (len(projects) > 1 or len(users) > 1):
+        raise ValueError("Listings of several owners can't use a checkpoint")
+
     opts = {}
     opts["all_tenants"] = True
     if status:
@@ -165,79 +493,580 @@ def all_servers(
         opts['image'] = image
     if changes_since:
         opts['changes-since'] = changes_since
-    if project:
-        try:
-            opts['tenant_id'] = keystone.get_project(
-                keystone.client(), project, use_cache=True
-            ).id
-        except Exception:
-            sys.exit(1)
-    if user:
-        try:
-            opts['user_id'] = keystone.get_user(
-                keystone.client(), user, use_cache=True
-            ).id
-        except Exception:
-            sys.exit(1)
+    if projects:
+        opts['tenant_id'] = _owner_ids(
+            keystone.get_project, keystone.project_cache, projects, workers
+        )
+    if users:
+        opts['user_id'] = _owner_ids(
+            keystone.get_user, keystone.user_cache, users, workers
+        )
 
     host_list = parse_nodes(host) if host else None
     az_list = parse_nodes(zone) if zone else None
-    ip_list = parse_nodes(ip) if ip else None
+    ip_list = AddressFilter(ip) if ip else None
+
+    if db is not None:
+        servers = iter_db_servers(db, opts, host_list, az_list, ip_list)
+        yield from itertools.islice(servers, int(limit) if limit else None)
+        return
+
+    if max_age is not None:
+        inventory = Inventory(inventory_path)
+        inventory.refresh(client, int(max_age))
+        servers = inventory.servers(client, opts, host_list, az_list, ip_list)
+        yield from itertools.islice(servers, int(limit) if limit else None)
+        return
+
+    device_ids = None
+    if use_neutron and ip_list:
+        device_ids = ip_list.device_ids(neutron.get_neutron_client())
+    if device_ids is not None:
+        servers = _iter_id_servers(
+            client, device_ids, opts, host_list, az_list, ip_list, workers
+        )
+        yield from itertools.islice(servers, int(limit) if limit else None)
+        return
+
+    if raw:
+        client = RawClient(client)
 
     # When using all the searching opts other than project or user,
     # trove instances will be returned by default via nova list api.
     # But they will not when search_opts contain project or user.
     # In order to include them, searching all the instances under
     # project "trove" and filtering them by the instance metadata.
-    if project or user:
-        inst = _search_trove_instances(client, opts)
-    else:
-        inst = []
-
-    if host_list:
-        for host in host_list:
-            opts['host'] = host
-            instances = client.servers.list(search_opts=opts)
-            if not instances:
-                continue
-            instances = filter(
-                lambda x: _match_availability_zone(x, az_list), instances
+    # The search runs alongside the main listing and its results are
+    # yielded as soon as it finishes.
+    trove = None
+    if projects or users:
+        executor = futures.ThreadPoolExecutor(1)
+        trove = executor.submit(_search_trove_instances, client, opts)
+        executor.shutdown(wait=False)
+
+    opts, az_list, ip_list = _plan_filters(
+        opts, az_list, ip_list, zone_pushdown
+    )
+    if partitions and checkpoint:
+        raise ValueError("Partitioned listings can't use a checkpoint")
+
+    def list_pages(opts):
+        if host_list:
+            return _iter_host_pages(
+                client, opts, host_list, az_list, ip_list, workers
             )
-            instances = filter(
-                lambda x: _match_ip_address(x, ip_list), instances
+        if partitions:
+            return _iter_window_pages(
+                client,
+                opts,
+                int(partitions),
+                az_list,
+                ip_list,
+                workers,
+                page_size,
             )
-            inst.extend(instances)
-            if limit and len(inst) >= int(limit):
-                break
-        return inst
+        return _iter_marker_pages(
+            client, opts, az_list, ip_list, page_size, checkpoint
+        )
+
+    # only the nova queries run per owner, the rest are done once above
+    split = _split_owners(opts)
+    if len(split) > 1:
+        pages = _iter_owners_pages(split, list_pages, workers)
     else:
-        while True:
-            if marker:
-                opts['marker'] = marker
-            instances = client.servers.list(search_opts=opts)
-            if not instances:
-                return inst
-            # for some instances stuck in build phase, servers.list api
-            # will always return the marker instance. Add old marker and
-            # new marker comparison to avoid the dead loop
-            marker_new = instances[-1].id
-            if marker == marker_new:
-                return inst
-            marker = marker_new
-            instances = filter(
-                lambda x: _match_availability_zone(x, az_list), instances
+        pages = list_pages(split[0])
+    count = 0
+    with contextlib.closing(pages):
+        for page in _merge_pending(pages, trove):
+            if limit:
+                page = page[: int(limit) - count]
+            yield from page
+            count += len(page)
+            if limit and count >= int(limit):
+                return
+
+
+def _merge_pending(pages, pending=None):
+    """Yield the pages, and the pending future's result once it is done"""
+    for page in pages:
+        if pending is not None and pending.done():
+            yield pending.result()
+            pending = None
+        yield page
+    if pending is not None:
+        yield pending.result()
+
+
+def _owner_list(value):
+    """Split a project or user option into a list of names or IDs
+
+    Takes a comma separated list, or the path to a file with one name
+    or ID per line.
+    """
+    if not value:
+        return []
+    if isinstance(value, (list, tuple)):
+        values = value
+    elif os.path.isfile(value):
+        with open(value) as f:
+            values = [line for line in f if not line.startswith('#')]
+    else:
+        values = value.split(',')
+    # keep the order but drop blanks and repeats
+    return list(dict.fromkeys(v.strip() for v in values if v.strip()))
+
+
+def _owner_id(lookup, cache, name_or_id, ksclient=None):
+    """Return the ID of a project or user, exiting if it isn't found"""
+    # the keystone caches are keyed by ID, so resolved IDs cost nothing
+    if name_or_id in cache:
+        return cache[name_or_id].id
+    try:
+        return lookup(
+            ksclient or keystone.client(), name_or_id, use_cache=True
+        ).id
+    except Exception:
+        sys.exit(1)
+
+
+def _owner_ids(lookup, cache, names, workers=DEFAULT_WORKERS):
+    """Resolve the project or user names, concurrently if there are many
+
+    Returns None for no names, the ID for a single name and a list of
+    IDs for several, as the local filters take either.
+    """
+    if not names:
+        return None
+    if len(names) == 1:
+        return _owner_id(lookup, cache, names[0])
+    ksclient = keystone.client()
+    with futures.ThreadPoolExecutor(max_workers=int(workers)) as pool:
+        ids = pool.map(
+            lambda name: _owner_id(lookup, cache, name, ksclient), names
+        )
+        return list(dict.fromkeys(ids))
+
+
+def _owner_values(value):
+    """Return the owner IDs in a tenant_id or user_id option as a list"""
+    return value if isinstance(value, list) else [value]
+
+
+def _split_owners(opts):
+    """Return the search options for each project and user pair in opts
+
+    nova filters on a single project and user at a time, so listings of
+    several owners run one query per pair.
+    """
+    pairs = itertools.product(
+        _owner_values(opts.get('tenant_id')),
+        _owner_values(opts.get('user_id')),
+    )
+    split = []
+    for project_id, user_id in pairs:
+        owner_opts = dict(opts, tenant_id=project_id, user_id=user_id)
+        split.append({k: v for k, v in owner_opts.items() if v is not None})
+    return split
+
+
+def _iter_owners_pages(split, list_pages, workers):
+    """Run list_pages for each owner's search options concurrently
+
+    The servers are yielded a page per owner, in the order the owners
+    were given, skipping any already listed for an earlier owner.
+    """
+    seen = set()
+    with futures.ThreadPoolExecutor(max_workers=int(workers)) as pool:
+        jobs = [
+            pool.submit(
+                lambda opts: [s for page in list_pages(opts) for s in page],
+                opts,
+            )
+            for opts in split
+        ]
+        try:
+            for job in jobs:
+                page = [s for s in job.result() if s.id not in seen]
+                seen.update(s.id for s in page)
+                yield page
+        finally:
+            for job in jobs:
+                job.cancel()
+
+
+def _plan_filters(opts, az_list=None, ip_list=None, zone_pushdown=False):
+    """Push the zone filter down into the nova search options if asked
+
+    Returns the new search options along with the zone and ip filters
+    which could not be expressed server side and so still need to be
+    checked against every server returned.
+
+    The zone is only pushed down with zone_pushdown. nova matches it
+    against the instance's requested availability_zone, which is empty
+    for instances booted without one, while the zone reported for them
+    comes from their host's aggregate. So pushing it down skips those
+    instances, but is much cheaper where every instance names its zone.
+
+    The ip filter always stays client side, as nova hands ip to neutron
+    as a substring match on fixed addresses only, which would drop
+    floating IP lookups.
+    """
+    opts = opts.copy()
+    # availability_zone is a regex match in nova, so anchor each zone
+    if zone_pushdown and az_list and len(az_list) <= MAX_PUSHDOWN_TERMS:
+        opts['availability_zone'] = '|'.join(
+            f'^{re.escape(zone)}$' for zone in sorted(az_list)
+        )
+        az_list = None
+    return opts, az_list, ip_list
+
+
+def _iter_host_pages(client, opts, hosts, az_list, ip_list, workers):
+    # query the hosts concurrently, but yield the results in host
+    # order so the output is the same from one run to the next
+    with futures.ThreadPoolExecutor(max_workers=int(workers)) as pool:
+        jobs = [
+            pool.submit(
+                _list_host_servers, client, opts, host, az_list, ip_list
             )
-            instances = filter(
-                lambda x: _match_ip_address(x, ip_list), instances
+            for host in sorted(hosts)
+        ]
+        try:
+            for job in jobs:
+                yield job.result()
+        finally:
+            # drop the queries not started yet if the caller stops early
+            for job in jobs:
+                job.cancel()
+
+
+def _iter_window_pages(
+    client, opts, partitions, az_list, ip_list, workers, page_size=None
+):
+    """Page through disjoint update time windows concurrently
+
+    Each window is a separate changes-since/changes-before marker chain,
+    so a full scan takes about as many round trips as its largest window
+    rather than the whole cloud. The windows all end when the scan
+    starts, and once they are done one more chain picks up the servers
+    updated since, which may have moved out of a window before it was
+    listed. A server can show up in more than one chain, so servers are
+    deduplicated by ID.
+    """
+    if client.api_version < api_versions.APIVersion(CHANGES_BEFORE_VERSION):
+        raise ValueError(
+            f"Partitioned listings need compute API {CHANGES_BEFORE_VERSION}"
+        )
+    # time filters make nova include deleted servers, which a plain
+    # listing only does when asked for them
+    keep_deleted = 'changes-since' in opts or opts.get('status') == 'DELETED'
+    start = _normalize_time(opts.get('changes-since', PARTITION_START))
+    end = datetime.datetime.now(dateutil.tz.tzutc())
+    windows = _time_windows(start, end, partitions)
+    since_end = {'changes-since': windows[-1]['changes-before']}
+
+    seen = set()
+    with futures.ThreadPoolExecutor(max_workers=int(workers)) as pool:
+        jobs = [
+            pool.submit(
+                _list_window,
+                client,
+                dict(opts, **window),
+                az_list,
+                ip_list,
+                page_size,
             )
-            if not instances:
-                continue
-            inst.extend(instances)
-            if limit and len(inst) >= int(limit):
-                return inst
+            for window in windows
+        ]
+        try:
+            for job in jobs:
+                page = [
+                    server
+                    for server in job.result()
+                    if server.id not in seen
+                    and (keep_deleted or server.status != 'DELETED')
+                ]
+                seen.update(server.id for server in page)
+                yield page
+        finally:
+            for job in jobs:
+                job.cancel()
+    servers = _list_window(
+        client, dict(opts, **since_end), az_list, ip_list, page_size
+    )
+    yield [
+        server
+        for server in servers
+        if server.id not in seen
+        and (keep_deleted or server.status != 'DELETED')
+    ]
+
+
+def _time_windows(start, end, partitions):
+    """Split start to end into changes-since/changes-before filters
+
+    The first window is left open so it also covers anything last
+    updated before start. The last is closed at end, as servers updated
+    after that are listed separately by _iter_window_pages.
+    """
+    step = (end - start) / partitions
+    bounds = [
+        (start + step * i).strftime('%Y-%m-%dT%H:%M:%SZ')
+        for i in range(1, partitions + 1)
+    ]
+    windows = []
+    for i in range(partitions):
+        window = {}
+        if i > 0:
+            window['changes-since'] = bounds[i - 1]
+        window['changes-before'] = bounds[i]
+        windows.append(window)
+    return windows
+
+
+def _list_window(client, opts, az_list, ip_list, page_size):
+    pages = _iter_marker_pages(client, opts, az_list, ip_list, page_size)
+    return [server for page in pages for server in page]
+
+
+def _iter_marker_pages(
+    client, opts, az_list=None, ip_list=None, page_size=None, checkpoint=None
+):
+    opts = opts.copy()
+    # a limit in opts caps the rows returned, apart from the page size
+    limit = opts.pop('limit', None)
+    remaining = int(limit) if limit else None
+    sizer = AdaptivePageSize() if page_size == 'auto' else None
+    marker = checkpoint.load(opts) if checkpoint else None
+    while True:
+        if marker:
+            opts['marker'] = marker
+        if sizer:
+            size = sizer.limit
+        else:
+            size = int(page_size) if page_size else None
+        # only ask for the rows still wanted, unless some of them will be
+        # filtered out here
+        if remaining is not None and not (az_list or ip_list):
+            size = min(size or remaining, remaining)
+        if size:
+            opts['limit'] = size
+        start = time.monotonic()
+        instances = _list_page(client, opts)
+        if sizer:
+            sizer.update(len(instances), time.monotonic() - start)
+        if not instances:
+            break
+        # for some instances stuck in build phase, servers.list api
+        # will always return the marker instance. Add old marker and
+        # new marker comparison to avoid the dead loop
+        marker_new = instances[-1].id
+        if marker == marker_new:
+            break
+        marker = marker_new
+        page = [
+            instance
+            for instance in instances
+            if _match_availability_zone(instance, az_list)
+            and _match_ip_address(instance, ip_list)
+        ]
+        if remaining is not None:
+            page = page[:remaining]
+            remaining -= len(page)
+        if checkpoint:
+            checkpoint.add(page)
+        yield page
+        if remaining == 0:
+            break
+
+
+def _list_page(client, opts):
+    # retry the transient server side errors a long scan can run into
+    for attempt in range(PAGE_RETRIES):
+        try:
+            return client.servers.list(search_opts=opts)
+        except nova_exceptions.ClientException as e:
+            if (e.code or 0) < 500 or attempt == PAGE_RETRIES - 1:
+                raise
+            time.sleep(2**attempt)
+
+
+def _checkpoint_key(opts):
+    return {k: v for k, v in opts.items() if k not in ('marker', 'limit')}
+
+
+class Checkpoint:
+    """Where to resume a marker paged listing, kept in a file
+
+    The marker only moves on when the consumer reports a row written
+    through written(), so servers still held in a batch or a buffer are
+    never skipped on resume. Rows from outside the marker chain, like
+    the trove instances, don't move it. Used as a context manager the
+    file is removed once the listing completes, and the latest marker is
+    saved if it fails part way.
+    """
+
+    def __init__(self, path, interval=1.0):
+        self.path = path
+        # seconds between saves of the marker while rows are written
+        self.interval = interval
+        self.opts = None
+        self.marker = None
+        self.saved = None
+        self.saved_at = 0
+        self.pending = collections.OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.remove()
+        else:
+            self.save()
+
+    def load(self, opts):
+        """Return the marker to resume from if the checkpoint matches"""
+        self.opts = _checkpoint_key(opts)
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as fh:
+            saved = json.load(fh)
+        if saved['opts'] != self.opts:
+            raise ValueError(
+                f"Checkpoint {self.path} is for a different query: "
+                f"{saved['opts']}"
+            )
+        print(f"Resuming from marker {saved['marker']}", file=sys.stderr)
+        self.marker = self.saved = saved['marker']
+        return self.marker
+
+    def add(self, servers):
+        """Note the servers handed on from the marker chain"""
+        self.pending.update((server.id, None) for server in servers)
+
+    def written(self, row):
+        """Move the marker past a row once it has been written out"""
+        if row['id'] not in self.pending:
+            return
+        # rows are written in listing order, so every earlier one is done
+        while True:
+            server_id = self.pending.popitem(last=False)[0]
+            if server_id == row['id']:
+                break
+        self.marker = server_id
+        if time.monotonic() - self.saved_at >= self.interval:
+            self.save()
+
+    def save(self):
+        if self.opts is None or self.marker == self.saved:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump({'opts': self.opts, 'marker': self.marker}, fh)
+        os.replace(tmp, self.path)
+        self.saved = self.marker
+        self.saved_at = time.monotonic()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class AdaptivePageSize:
+    """Pick the page size for the next request from the last one
+
+    Aims for pages which take about target seconds to fetch, growing by
+    at most double each page, and stops growing once the server returns
+    fewer servers than asked for as that is its own max_limit.
+    """
+
+    def __init__(
+        self, limit=100, minimum=50, maximum=MAX_PAGE_SIZE, target=2.0
+    ):
+        self.limit = limit
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target = target
+
+    def update(self, returned, elapsed):
+        if not returned:
+            return
+        if returned < self.limit:
+            self.maximum = max(self.minimum, returned)
+        ideal = int(self.target * returned / max(elapsed, 1e-3))
+        self.limit = max(
+            self.minimum, min(ideal, self.limit * 2, self.maximum)
+        )
+
+
+def _list_host_servers(client, opts, host, az_list=None, ip_list=None):
+    host_opts = dict(opts, host=host)
+    instances = client.servers.list(search_opts=host_opts)
+    return [
+        instance
+        for instance in instances
+        if _match_availability_zone(instance, az_list)
+        and _match_ip_address(instance, ip_list)
+    ]
+
+
+def _iter_id_servers(client, ids, opts, host_list, az_list, ip_list, workers):
+    """Fetch the servers with the given IDs, keeping those matching opts"""
+
+    def get(server_id):
+        try:
+            return client.servers.get(server_id)
+        except nova_exceptions.NotFound:
+            return None
+
+    with futures.ThreadPoolExecutor(max_workers=int(workers)) as pool:
+        for server in pool.map(get, sorted(ids)):
+            if (
+                server is not None
+                and _match_search_opts(server, opts)
+                and (
+                    not host_list
+                    or getattr(server, 'OS-EXT-SRV-ATTR:host') in host_list
+                )
+                and _match_availability_zone(server, az_list)
+                and _match_ip_address(server, ip_list)
+            ):
+                yield server
+
+
+def _match_search_opts(server, opts):
+    """Check a server against the search options nova would apply"""
+    if opts.get('status') and server.status != opts['status'].upper():
+        return False
+    if opts.get('image'):
+        image = getattr(server, 'image', None)
+        if not image or image.get('id') != opts['image']:
+            return False
+    # trove instances belong to their owner in the metadata
+    user, project = _server_owner(server)
+    if opts.get('tenant_id') and not {server.tenant_id, project} & set(
+        _owner_values(opts['tenant_id'])
+    ):
+        return False
+    if opts.get('user_id') and not {server.user_id, user} & set(
+        _owner_values(opts['user_id'])
+    ):
+        return False
+    if opts.get('changes-since') and _normalize_time(
+        server.updated
+    ) < _normalize_time(opts['changes-since']):
+        return False
+    return True
 
 
 def _search_trove_instances(client, opts):
+    """Return the trove instances owned by the projects or users in opts
+
+    The owner is only recorded in the instance metadata, which the nova
+    API can't filter on, so the trove project's instances are paged
+    through and matched here.
+    """
     # keep the proj/user from searching opts
     proj_id = opts.get('tenant_id', None)
     user_id = opts.get('user_id', None)
@@ -245,25 +1074,28 @@ def _search_trove_instances(client, opts):
     # trove instances will be launched by global trove project
     trove_opts = opts.copy()
     trove_opts.pop('user_id', None)
-    trove_opts['tenant_id'] = keystone.get_project(
-        keystone.client(), 'trove', use_cache=True
-    ).id
-    trove_instances = client.servers.list(search_opts=trove_opts)
-    trove_instances = [
+    trove_opts['tenant_id'] = _owner_id(
+        keystone.get_project, keystone.project_cache, 'trove'
+    )
+    limit = trove_opts.get('limit')
+    trove_instances = (
         instance
-        for instance in trove_instances
+        for page in _iter_marker_pages(client, trove_opts)
+        for instance in page
         if _match_proj_user(instance, proj_id, user_id)
-    ]
-    return trove_instances
+    )
+    return list(
+        itertools.islice(trove_instances, int(limit) if limit else None)
+    )
 
 
 def _match_proj_user(server, proj_id=None, user_id=None):
     # server.metadata will return dict containing user's projectid and userid
     if proj_id:
-        if getattr(server, 'metadata').get("project_id") != proj_id:
+        if server.metadata.get("project_id") not in _owner_values(proj_id):
             return False
     if user_id:
-        if getattr(server, 'metadata').get("user_id") != user_id:
+        if server.metadata.get("user_id") not in _owner_values(user_id):
             return False
     return True
 
@@ -278,25 +1110,596 @@ def _match_availability_zone(server, az=None):
 def _match_ip_address(server, ips):
     if not ips:
         return True
-    for ip in ips:
-        if any(
-            map(
-                lambda a: any(map(lambda aa: ip in aa['addr'], a)),
-                server.addresses.values(),
+    for addresses in server.addresses.values():
+        for address in addresses:
+            if address['addr'] in ips:
+                return True
+    return False
+
+
+class RawServer:
+    """The fields of a server listing which hivemind reads
+
+    A lighter stand in for a novaclient Server, built straight from the
+    servers/detail JSON. The extended attributes are available under
+    their API names too, so it can be passed anywhere a Server is.
+    """
+
+    __slots__ = (
+        'id',
+        'name',
+        'status',
+        'flavor',
+        'image',
+        'user_id',
+        'tenant_id',
+        'metadata',
+        'addresses',
+        'updated',
+        'host',
+        'zone',
+    )
+    EXTENDED = {
+        'OS-EXT-SRV-ATTR:host': 'host',
+        'OS-EXT-AZ:availability_zone': 'zone',
+    }
+
+    def __init__(self, data):
+        for name in self.__slots__:
+            setattr(self, name, data.get(name))
+        for key, name in self.EXTENDED.items():
+            setattr(self, name, data.get(key))
+
+    def __getattr__(self, name):
+        if name not in self.EXTENDED:
+            raise AttributeError(name)
+        return getattr(self, self.EXTENDED[name])
+
+    def __repr__(self):
+        return f'<RawServer: {self.name}>'
+
+    def to_dict(self):
+        data = {name: getattr(self, name) for name in self.__slots__}
+        for key, name in self.EXTENDED.items():
+            data[key] = data.pop(name)
+        return data
+
+
+def iter_db_servers(db, opts, host_list=None, az_list=None, ip_list=None):
+    """Yield RawServers read straight from a nova database
+
+    Takes the same search options as the servers API and turns them into
+    SQL predicates, so a read replica can answer large audits without
+    going through the API. Rows are streamed from a server side cursor.
+    """
+    instances = instances_table
+    extra = instance_extra_table
+    caches = instance_info_caches_table
+    owner_user = instance_metadata_table.alias('owner_user')
+    owner_project = instance_metadata_table.alias('owner_project')
+
+    def owner_join(table, key):
+        return and_(
+            table.c.instance_uuid == instances.c.uuid,
+            table.c.key == key,
+            table.c.deleted == 0,
+        )
+
+    query = (
+        select(
+            instances,
+            extra.c.flavor,
+            caches.c.network_info,
+            owner_user.c.value.label('owner_user'),
+            owner_project.c.value.label('owner_project'),
+        )
+        .select_from(
+            instances.outerjoin(
+                extra,
+                and_(
+                    extra.c.instance_uuid == instances.c.uuid,
+                    extra.c.deleted == 0,
+                ),
             )
+            .outerjoin(
+                caches,
+                and_(
+                    caches.c.instance_uuid == instances.c.uuid,
+                    caches.c.deleted == 0,
+                ),
+            )
+            .outerjoin(owner_user, owner_join(owner_user, 'user_id'))
+            .outerjoin(owner_project, owner_join(owner_project, 'project_id'))
+        )
+        .order_by(desc(instances.c.created_at), desc(instances.c.uuid))
+    )
+
+    # like the API, deleted instances only show up in changes-since
+    # listings or when asked for by status
+    if 'changes-since' in opts:
+        query = query.where(
+            instances.c.updated_at >= _normalize_time(opts['changes-since'])
+        )
+    elif opts.get('status') != 'DELETED':
+        query = query.where(instances.c.deleted == 0)
+    if opts.get('status'):
+        vm_state = VM_STATES.get(opts['status'].upper(), opts['status'])
+        query = query.where(instances.c.vm_state == vm_state)
+    if opts.get('image'):
+        query = query.where(instances.c.image_ref == opts['image'])
+    if opts.get('tenant_id'):
+        project_ids = _owner_values(opts['tenant_id'])
+        query = query.where(
+            or_(
+                instances.c.project_id.in_(project_ids),
+                owner_project.c.value.in_(project_ids),
+            )
+        )
+    if opts.get('user_id'):
+        user_ids = _owner_values(opts['user_id'])
+        query = query.where(
+            or_(
+                instances.c.user_id.in_(user_ids),
+                owner_user.c.value.in_(user_ids),
+            )
+        )
+    # small host and zone lists become IN clauses, and any others are
+    # matched against each row instead
+    if host_list and len(host_list) <= MAX_PUSHDOWN_TERMS:
+        query = query.where(instances.c.host.in_(sorted(host_list)))
+        host_list = None
+    if az_list and len(az_list) <= MAX_PUSHDOWN_TERMS:
+        query = query.where(instances.c.availability_zone.in_(sorted(az_list)))
+        az_list = None
+    if opts.get('limit') and not (host_list or az_list or ip_list):
+        query = query.limit(int(opts['limit']))
+
+    result = db.execution_options(
+        stream_results=True, yield_per=DB_BATCH_SIZE
+    ).execute(query)
+    for row in result:
+        server = RawServer(_db_server(row._mapping))
+        if (
+            (not host_list or server.host in host_list)
+            and _match_availability_zone(server, az_list)
+            and _match_ip_address(server, ip_list)
         ):
-            return True
-    return False
+            yield server
+
+
+def _db_server(row):
+    """Build the servers API representation of a nova database row"""
+    flavor = json.loads(row['flavor']) if row['flavor'] else {}
+    flavor = (flavor.get('cur') or {}).get('nova_object.data', {})
+    metadata = {}
+    if row['owner_user'] is not None:
+        metadata['user_id'] = row['owner_user']
+    if row['owner_project'] is not None:
+        metadata['project_id'] = row['owner_project']
+    updated = row['updated_at'] or row['created_at']
+    return {
+        'id': row['uuid'],
+        'name': row['display_name'],
+        'status': VM_STATUSES.get(row['vm_state'], 'UNKNOWN'),
+        'flavor': {'id': flavor.get('flavorid')},
+        'image': {'id': row['image_ref']} if row['image_ref'] else '',
+        'user_id': row['user_id'],
+        'tenant_id': row['project_id'],
+        'metadata': metadata,
+        'addresses': _db_addresses(row['network_info']),
+        'updated': updated.strftime('%Y-%m-%dT%H:%M:%SZ') if updated else None,
+        'OS-EXT-SRV-ATTR:host': row['host'],
+        'OS-EXT-AZ:availability_zone': row['availability_zone'],
+    }
+
+
+def _db_addresses(network_info):
+    """Turn an instance's cached network info into the API addresses"""
+    addresses = {}
+    for vif in json.loads(network_info) if network_info else []:
+        network = vif.get('network') or {}
+        ips = addresses.setdefault(network.get('label'), [])
+        for subnet in network.get('subnets', []):
+            for ip in subnet.get('ips', []):
+                ips.append({'addr': ip['address'], 'version': ip['version']})
+                for floating in ip.get('floating_ips', []):
+                    ips.append(
+                        {'addr': floating['address'], 'version': ip['version']}
+                    )
+    return addresses
+
+
+class RawServerManager:
+    """Lists servers/detail without building novaclient resources"""
+
+    def __init__(self, client):
+        self.api = client
+
+    def list(self, search_opts=None):
+        # the same query string novaclient would send
+        params = {k: v for k, v in (search_opts or {}).items() if v}
+        url = '/servers/detail'
+        if params:
+            url += '?' + parse.urlencode(sorted(params.items()))
+        resp, body = self.api.client.get(url)
+        return [RawServer(server) for server in body['servers']]
+
+
+class RawClient:
+    """A novaclient Client whose servers.list returns RawServers"""
+
+    def __init__(self, client):
+        self._client = client
+        self.servers = RawServerManager(client)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+class AddressFilter:
+    """A compiled set of IP addresses and CIDR ranges to match against
+
+    Accepts the parse_nodes syntax as well as CIDR notation, e.g.
+    192.168.122.[124-127],10.0.0.0/16. Single addresses are kept in a set
+    and ranges in a sorted list of merged intervals, so each lookup is
+    O(log n) however many addresses the expression covers. Values which
+    are not complete addresses are matched as substrings, as before.
+    """
+
+    def __init__(self, expression):
+        self.addresses = set()
+        self.networks = []
+        self.partials = []
+        intervals = []
+        for value in parse_nodes(expression):
+            try:
+                if '/' in value:
+                    network = ipaddress.ip_network(value, strict=False)
+                    self.networks.append(network)
+                    intervals.append(
+                        (
+                            (network.version, int(network.network_address)),
+                            (network.version, int(network.broadcast_address)),
+                        )
+                    )
+                else:
+                    self.addresses.add(ipaddress.ip_address(value))
+            except ValueError:
+                self.partials.append(value)
+
+        # merge overlapping ranges so a single bisect finds the candidate
+        self.starts = []
+        self.ends = []
+        for start, end in sorted(intervals):
+            if self.ends and start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def __contains__(self, address):
+        if not address:
+            return False
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            ip = None
+        if ip is not None:
+            if ip in self.addresses:
+                return True
+            key = (ip.version, int(ip))
+            i = bisect.bisect_right(self.starts, key) - 1
+            if i >= 0 and key <= self.ends[i]:
+                return True
+        return any(partial in address for partial in self.partials)
+
+    def device_ids(self, neutron_client):
+        """Return the IDs of the instances on these addresses via neutron
+
+        Returns None when the filter holds partial addresses, which
+        neutron has no way to look up.
+        """
+        if self.partials:
+            return None
+        return neutron.find_device_ids(
+            neutron_client, self.addresses, self.networks
+        )
+
+
+class Inventory:
+    """A local sqlite snapshot of the instances in the cloud
+
+    The snapshot is populated with one full listing and then kept up to
+    date with changes-since deltas, which also report deleted instances.
+    The raw server records are stored so the servers handed back are the
+    same novaclient Server objects the API would return.
+
+    A refresh stages the listing in a temporary table, so the snapshot
+    is only locked for the short swap at the end and other processes can
+    keep reading and refreshing it meanwhile.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS instances (
+            uuid TEXT PRIMARY KEY,
+            host TEXT,
+            zone TEXT,
+            status TEXT,
+            image TEXT,
+            project TEXT,
+            user TEXT,
+            updated TEXT,
+            data TEXT
+        );
+        CREATE INDEX IF NOT EXISTS instances_host ON instances (host);
+        CREATE INDEX IF NOT EXISTS instances_zone ON instances (zone);
+        CREATE INDEX IF NOT EXISTS instances_project ON instances (project);
+        CREATE TABLE IF NOT EXISTS sync (
+            synced_at REAL,
+            watermark TEXT
+        );
+        CREATE TEMP TABLE IF NOT EXISTS staging (
+            uuid TEXT PRIMARY KEY,
+            deleted INTEGER,
+            host TEXT,
+            zone TEXT,
+            status TEXT,
+            image TEXT,
+            project TEXT,
+            user TEXT,
+            updated TEXT,
+            data TEXT
+        );
+    '''
+
+    def __init__(self, path=INVENTORY_PATH):
+        path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=INVENTORY_TIMEOUT)
+        self.db.executescript(self.SCHEMA)
+
+    def age(self):
+        """Seconds since the last refresh, or None if never populated"""
+        row = self.db.execute('SELECT synced_at FROM sync').fetchone()
+        return time.time() - row[0] if row else None
+
+    def refresh(self, client, max_age=0):
+        """Bring the snapshot up to date unless it is under max_age old"""
+        age = self.age()
+        if age is not None and age <= max_age:
+            return
+        row = self.db.execute('SELECT watermark FROM sync').fetchone()
+        watermark = row[0] if row else None
+        opts = {'all_tenants': True}
+        if watermark:
+            opts['changes-since'] = watermark
+        synced_at = time.time()
+        full = not watermark
+        with self.db:
+            self.db.execute('DELETE FROM staging')
+        for page in _iter_marker_pages(client, opts):
+            with self.db:
+                self._stage(page)
+            # go by nova's update times rather than the local clock,
+            # which may run ahead of nova's and skip changes
+            for server in page:
+                if watermark is None or server.updated > watermark:
+                    watermark = server.updated
+        with self.db:
+            if full:
+                self.db.execute('DELETE FROM instances')
+            self.db.execute(
+                'DELETE FROM instances WHERE uuid IN '
+                '(SELECT uuid FROM staging WHERE deleted)'
+            )
+            self.db.execute(
+                'INSERT OR REPLACE INTO instances '
+                'SELECT uuid, host, zone, status, image, project, user, '
+                'updated, data FROM staging WHERE NOT deleted'
+            )
+            self.db.execute('DELETE FROM sync')
+            self.db.execute(
+                'INSERT INTO sync VALUES (?, ?)', (synced_at, watermark)
+            )
+        with self.db:
+            self.db.execute('DELETE FROM staging')
+
+    def _stage(self, servers):
+        for server in servers:
+            image = getattr(server, 'image', None)
+            user, project = _server_owner(server)
+            self.db.execute(
+                'INSERT OR REPLACE INTO staging '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    server.id,
+                    server.status == 'DELETED',
+                    getattr(server, 'OS-EXT-SRV-ATTR:host'),
+                    getattr(server, 'OS-EXT-AZ:availability_zone'),
+                    server.status,
+                    image.get('id') if image else None,
+                    project,
+                    user,
+                    _normalize_time(server.updated).isoformat(),
+                    json.dumps(server.to_dict()),
+                ),
+            )
+
+    def servers(
+        self, client, opts, host_list=None, az_list=None, ip_list=None
+    ):
+        """Yield the servers in the snapshot matching the search options"""
+        where = []
+        args = []
+        for column, values in (('host', host_list), ('zone', az_list)):
+            if values:
+                where.append(f'{column} IN (SELECT value FROM json_each(?))')
+                args.append(json.dumps(list(values)))
+        for column, key in (
+            ('status', 'status'),
+            ('image', 'image'),
+        ):
+            if opts.get(key):
+                where.append(f'{column} = ?')
+                args.append(opts[key])
+        for column, key in (('project', 'tenant_id'), ('user', 'user_id')):
+            if opts.get(key):
+                where.append(f'{column} IN (SELECT value FROM json_each(?))')
+                args.append(json.dumps(_owner_values(opts[key])))
+        if opts.get('changes-since'):
+            where.append('updated >= ?')
+            args.append(_normalize_time(opts['changes-since']).isoformat())
+
+        query = 'SELECT data FROM instances'
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        for (data,) in self.db.execute(query + ' ORDER BY host, uuid', args):
+            server = nova_servers.Server(
+                client.servers, json.loads(data), loaded=True
+            )
+            if _match_ip_address(server, ip_list):
+                yield server
+
+
+class AggregateIndex:
+    """Host membership of the aggregates in an availability zone
+
+    Both directions are indexed, aggregate name to a set of hosts and
+    host to the set of aggregate names, so building a host/aggregate
+    matrix costs one set lookup per cell. The index is cached on disk
+    per availability zone and rebuilt once it is older than max_age.
+    """
+
+    def __init__(self, hosts, built_at=None):
+        self.hosts = {name: frozenset(h) for name, h in hosts.items()}
+        self.aggregates = {}
+        for name, members in self.hosts.items():
+            for host in members:
+                self.aggregates.setdefault(host, set()).add(name)
+        self.built_at = time.time() if built_at is None else built_at
+
+    @classmethod
+    def from_aggregates(cls, aggregates, availability_zone):
+        return cls(
+            {
+                aggregate.name: aggregate.hosts
+                for aggregate in aggregates
+                if aggregate.availability_zone == availability_zone
+            }
+        )
+
+    @classmethod
+    def load(
+        cls,
+        client,
+        availability_zone,
+        max_age=AGGREGATE_INDEX_TTL,
+        path=AGGREGATE_INDEX_PATH,
+    ):
+        """Return the cached index for the zone, rebuilding it if stale"""
+        path = os.path.expanduser(path)
+        try:
+            with open(path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+        cached = cache.get(availability_zone)
+        if cached and time.time() - cached['built_at'] <= max_age:
+            return cls(cached['hosts'], cached['built_at'])
+
+        index = cls.from_aggregates(
+            client.aggregates.list(), availability_zone
+        )
+        cache[availability_zone] = {
+            'built_at': index.built_at,
+            'hosts': {name: sorted(h) for name, h in index.hosts.items()},
+        }
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(cache, f)
+        os.replace(path + '.tmp', path)
+        return index
+
+    def all_hosts(self):
+        return sorted(self.aggregates)
+
+    def matrix(self, hosts):
+        """Yield a row per aggregate, with a member flag for each host"""
+        for name in sorted(self.hosts):
+            members = self.hosts[name]
+            row = {'aggregate': name}
+            row.update((host, host in members) for host in hosts)
+            yield row
+
+
+class ServerInfo:
+    """Compact record of the server details used for listings and mailouts
+
+    Fields can be read as attributes or by key (info['id']), and keys(),
+    values() and items() follow the field order, so it can stand in for
+    the per-server dicts used in tables and notification templates.
+    """
+
+    __slots__ = (
+        'id',
+        'name',
+        'status',
+        'flavor',
+        'host',
+        'zone',
+        'image',
+        'user',
+        'project',
+        'addresses',
+        'project_name',
+        'email',
+        'fullname',
+    )
+
+    def __init__(self, **fields):
+        for field in self.__slots__:
+            setattr(self, field, fields.get(field))
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __eq__(self, other):
+        if not isinstance(other, ServerInfo):
+            return NotImplemented
+        return self.values() == other.values()
+
+    def __repr__(self):
+        return f'ServerInfo({self.to_dict()!r})'
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def values(self):
+        return [getattr(self, field) for field in self.__slots__]
+
+    def items(self):
+        return list(zip(self.keys(), self.values()))
+
+    def to_dict(self):
+        return dict(self.items())
 
 
 def extract_server_info(server, ksclient):
-    server_info = collections.defaultdict(dict)
+    server_info = {}
     try:
         server_info['id'] = server.id
         server_info['name'] = server.name
         server_info['status'] = server.status
 
-        server_info['flavor'] = server.flavor['id']
+        # from compute API 2.47 the flavor is embedded without its id
+        server_info['flavor'] = server.flavor.get('id') or server.flavor.get(
+            'original_name'
+        )
         server_info['host'] = getattr(server, "OS-EXT-SRV-ATTR:host")
         server_info['zone'] = getattr(server, "OS-EXT-AZ:availability_zone")
 
@@ -307,17 +1710,7 @@ def extract_server_info(server, ksclient):
         else:
             server_info['image'] = None
 
-        # handle some tier2 services which using "global" service user/project
-        if (
-            server.metadata
-            and 'user_id' in server.metadata.keys()
-            and 'project_id' in server.metadata.keys()
-        ):
-            server_info['user'] = server.metadata['user_id']
-            server_info['project'] = server.metadata['project_id']
-        else:
-            server_info['user'] = server.user_id
-            server_info['project'] = server.tenant_id
+        server_info['user'], server_info['project'] = _server_owner(server)
 
         server_info['addresses'] = _extract_ip(server)
 
@@ -338,9 +1731,21 @@ def extract_server_info(server, ksclient):
         else:
             server_info['email'], server_info['fullname'] = user.name, None
     except KeyError as e:
-        raise type(e)(e.message + f' missing in context: {server.to_dict()}')
+        raise KeyError(f'{e} missing in context: {server.to_dict()}') from e
+
+    return ServerInfo(**server_info)
 
-    return server_info
+
+def _server_owner(server):
+    """Return the (user id, project id) the server belongs to"""
+    # handle some tier2 services which using "global" service user/project
+    if (
+        server.metadata
+        and 'user_id' in server.metadata.keys()
+        and 'project_id' in server.metadata.keys()
+    ):
+        return server.metadata['user_id'], server.metadata['project_id']
+    return server.user_id, server.tenant_id
 
 
 def _extract_ip(server):
@@ -353,40 +1758,9 @@ def _extract_ip(server):
     return list(addresses)
 
 
-def parse_dash(range_str):
-    """Unpack the dash syntax into a set of number"""
-    hosts = range_str.split("-")
-    leading = len(hosts[0])
-    range_list = (
-        range(int(hosts[0]), int(hosts[1]) + 1)
-        if len(hosts) > 1
-        else [range_str]
-    )
-    return map(lambda x: str(x).zfill(leading), range_list)
-
-
 def parse_nodes(nodes):
-    """Parse list syntax (eg. qh2-rcc[01-10,13])"""
-
-    # Parse qh2-rcc5,qh2-rcc6,qh2-rcc7 syntax
-    nodes = re.split(r",\s*(?![^\[\]]*\])", nodes)
-
-    if len(nodes) > 1:
-        nodes = set(host for hosts in nodes for host in parse_nodes(hosts))
-    else:
-        # Parse qh2-rcc[112-114,115] syntax
-        match = re.search(r"(.*?)\[(.*?)\](.*)", nodes[0])
-        if match:
-            host_ranges = [
-                host
-                for hosts in parse_nodes(match.group(2))
-                for host in parse_dash(hosts)
-            ]
-            nodes = set(
-                f"{match.group(1)}{host}{match.group(3)}"
-                for host in host_ranges
-            )
-    return nodes
+    """Parse list syntax (eg. qh2-rcc[01-10,13]) into a HostList"""
+    return hostlist.HostList(nodes)
 
 
 def combine_files(file_contents):
@@ -412,25 +1786,29 @@ def combine_files(file_contents):
     return combined_message
 
 
-def file_contents(filenames):
-    for filename in filenames:
-        url = parse.urlsplit(filename)
-        if url.scheme == 'swift':
-            resp = swift_client().get_object(url.netloc, url.path.strip('/'))
-            yield resp[1]
-        elif not url.scheme:
-            with open(url.path) as fh:
-                yield fh.read()
-        else:
-            raise ValueError(f'Unrecognised url scheme {url.scheme}')
+def file_contents(filenames, workers=DEFAULT_WORKERS):
+    """Yield the contents of each file, fetching them concurrently"""
+    with futures.ThreadPoolExecutor(workers) as executor:
+        yield from executor.map(_file_contents, filenames)
+
+
+def _file_contents(filename):
+    url = parse.urlsplit(filename)
+    if url.scheme == 'swift':
+        contents = swift.get_object_cached(url.netloc, url.path.strip('/'))
+        return contents.decode()
+    elif not url.scheme:
+        with open(url.path) as fh:
+            return fh.read()
+    else:
+        raise ValueError(f'Unrecognised url scheme {url.scheme}')
 
 
 def _scenario_compute_failure(novaclient, server, changes_since):
     try:
         last_action = list_instance_actions(novaclient, server['id'])[0]
         if (
-            _normalize_time(last_action.start_time)
-            >= _normalize_time(changes_since)
+            _normalize_time(last_action.start_time) >= changes_since
             and last_action.action == "stop"
             and not last_action.project_id
             and not last_action.user_id
@@ -440,10 +1818,35 @@ def _scenario_compute_failure(novaclient, server, changes_since):
             return False
     except Exception as e:
         # bypass the failure when instance action call return failures
-        print("\nException {} with server {}".format(e, server['id']))
+        print(
+            "\nException {} with server {}".format(e, server['id']),
+            file=sys.stderr,
+        )
         return False
 
 
+def _timeout_client(novaclient, timeout):
+    """Return a copy of the client whose requests give up after timeout
+
+    The copy shares the client's token and connection pool. Scenario
+    checks use it, so a hung API call fails and frees its worker rather
+    than holding up every check queued behind it.
+    """
+    adapter = novaclient.client
+    sess = ks_session.Session(
+        auth=adapter.session.auth,
+        session=adapter.session.session,
+        verify=adapter.session.verify,
+        cert=adapter.session.cert,
+        timeout=timeout,
+    )
+    return nova_client.Client(
+        novaclient.api_version.get_string(),
+        session=sess,
+        region_name=adapter.region_name,
+    )
+
+
 def _normalize_time(string):
     t1 = dateutil.parser.parse(string)
     t2 = t1.replace(tzinfo=dateutil.tz.tzutc())
@@ -453,19 +1856,120 @@ def _normalize_time(string):
 @Spinner
 def extract_servers_info(servers, ksclient=None):
     print("\nExtracting instances information... ", end="")
+    return list(iter_servers_info(servers, ksclient=ksclient))
+
+
+def iter_servers_info(servers, ksclient=None, batch_size=1000):
     if ksclient is None:
         ksclient = keystone.client()
-    return [
-        extract_server_info(server, ksclient=ksclient) for server in servers
-    ]
+    servers = iter(servers)
+    while True:
+        batch = list(itertools.islice(servers, batch_size))
+        if not batch:
+            return
+        # warm the keystone caches for the whole batch up front rather
+        # than looking each project and user up one server at a time
+        owners = [_server_owner(server) for server in batch]
+        keystone.prefetch_projects(ksclient, {p for u, p in owners})
+        keystone.prefetch_users(ksclient, {u for u, p in owners})
+        for server in batch:
+            yield extract_server_info(server, ksclient=ksclient)
 
 
 @Spinner
-def match_scenario(servers, func, novaclient, changes_since):
+def match_scenario(
+    servers,
+    func,
+    novaclient,
+    changes_since,
+    workers=DEFAULT_WORKERS,
+    timeout=SCENARIO_TIMEOUT,
+):
     print("\nFiltering by scenario checking... ", end="")
-    return [
-        server for server in servers if func(novaclient, server, changes_since)
-    ]
+    return list(
+        iter_scenario_matches(
+            servers, func, novaclient, changes_since, workers, timeout
+        )
+    )
+
+
+def iter_scenario_matches(
+    servers,
+    func,
+    novaclient,
+    changes_since,
+    workers=DEFAULT_WORKERS,
+    timeout=SCENARIO_TIMEOUT,
+    batch_size=1000,
+):
+    if changes_since:
+        # parse the time once here rather than once per server checked
+        changes_since = _normalize_time(changes_since)
+    servers = iter(servers)
+    pool = futures.ThreadPoolExecutor(max_workers=int(workers))
+    try:
+        while True:
+            batch = list(itertools.islice(servers, batch_size))
+            if not batch:
+                return
+            started = [None] * len(batch)
+
+            def check(i, server):
+                started[i] = time.monotonic()
+                return func(novaclient, server, changes_since)
+
+            jobs = [
+                pool.submit(check, i, server) for i, server in enumerate(batch)
+            ]
+            for i, (server, job) in enumerate(zip(batch, jobs)):
+                # time each check from when it starts running, so checks
+                # queued behind slow ones still get their full timeout
+                while not job.done():
+                    if started[i] is None:
+                        remaining = timeout
+                    else:
+                        remaining = started[i] + timeout - time.monotonic()
+                        if remaining <= 0:
+                            break
+                    futures.wait([job], timeout=remaining)
+                if not job.done():
+                    print(
+                        "\nTimed out checking server {}".format(server['id']),
+                        file=sys.stderr,
+                    )
+                elif job.result():
+                    yield server
+    finally:
+        # don't wait on checks which are hung or no longer needed
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def write_rows(rows, output_format, columns, out=None, written=None):
+    """Write each row out as soon as it arrives, returning the row count
+
+    :param str output_format: csv or jsonl
+    :param list columns: The fields of each row to write
+    :param written: Called with each row once it has been flushed
+    """
+    if out is None:
+        out = sys.stdout
+    if output_format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(columns)
+    count = 0
+    for row in rows:
+        values = [row[column] for column in columns]
+        if output_format == 'csv':
+            writer.writerow(
+                [' '.join(v) if isinstance(v, list) else v for v in values]
+            )
+        else:
+            out.write(json.dumps(dict(zip(columns, values))) + '\n')
+        out.flush()
+        if written:
+            written(row)
+        count += 1
+    return count
 
 
 @task
@@ -479,10 +1983,13 @@ def boot(
     networks=[],
     userdata=[],
     availability_zone=DEFAULT_AZ,
+    count=1,
+    timeout=BOOT_TIMEOUT,
 ):
-    """Boot a new server.
+    """Boot one or more new servers.
 
-    :param str name: The name you want to give the VM.
+    :param str name: The name you want to give the VM. When booting
+      more than one, nova names them name-1, name-2, etc.
     :param str keyname: Key name of keypair that should be used.
     :param str flavor: Name or ID of flavor,
     :param str security_groups: Comma separated list of security
@@ -498,6 +2005,8 @@ def boot(
     :param str availability_zone: The availability zone for
       instance placement.
     :param choices ubuntu: The version of ubuntu you would like to use.
+    :param int count: The number of servers to boot in one request.
+    :param int timeout: Seconds to wait for the servers to get an address.
 
     """
     nova = client()
@@ -511,7 +2020,8 @@ def boot(
             key, value = option.split('=')
             nics[-1][key] = value
 
-    resp = nova.servers.create(
+    count = int(count)
+    reservation_id = nova.servers.create(
         name=name,
         flavor=flavor_id,
         security_groups=security_groups.split(','),
@@ -520,66 +2030,366 @@ def boot(
         nics=nics,
         availability_zone=availability_zone,
         key_name=key_name,
+        min_count=count,
+        max_count=count,
+        reservation_id=True,
     )
 
-    server_id = resp.id
-    ip_address = wait_for(
-        lambda: server_address(nova, resp.id),
-        "Server never got an IP address.",
-    )
-    print(server_id)
-    print(ip_address)
+    addresses = wait_for_addresses(nova, reservation_id, count, int(timeout))
+    for server_id, (name, ip_address) in sorted(
+        addresses.items(), key=lambda item: item[1]
+    ):
+        print(server_id)
+        print(ip_address)
 
 
 @task
 @decorators.verbose
-def list_host_aggregates(availability_zone, hostname=[]):
+def list_host_aggregates(
+    availability_zone,
+    hostname=None,
+    format='table',
+    max_age=None,
+    clouds=None,
+):
     """Prints a pretty table of hosts in for each aggregate in AZ
 
     :param str availability_zone: The availability zone that the aggregates
       are in
-    :param str hostname: Only display hostname in table. Use multiple times
-      for more then one host
+    :param str hostname: Only display these hosts in the table, using the
+      list syntax (eg. qh2-rcc[01-10,13])
+    :param str format: Output format, one of table, csv or jsonl
+    :param int max_age: Use the cached aggregate index if it is less than
+      this many seconds old (default 300, 0 to always fetch)
+    :param str clouds: Comma separated cloud profiles to fetch the
+      aggregates of concurrently, each row tagged with its region
     """
+    if format not in OUTPUT_FORMATS:
+        error(f"Unknown format {format}, use one of {OUTPUT_FORMATS}")
+    if max_age is None:
+        max_age = AGGREGATE_INDEX_TTL
+
+    if clouds:
+        # one cache file per cloud, as the zone names may be shared
+        indexes = fan_out(
+            clouds,
+            lambda profile, novaclient, ksclient: AggregateIndex.load(
+                novaclient,
+                availability_zone,
+                int(max_age),
+                path=_cloud_path(AGGREGATE_INDEX_PATH, profile),
+            ),
+        )
+    else:
+        indexes = [
+            (
+                None,
+                AggregateIndex.load(client(), availability_zone, int(max_age)),
+            )
+        ]
 
-    nova = client()
-
-    # filters for aggregates in availability_zone
-    aggregate_list = nova.aggregates.list()
-    aggregates = []
-    for aggregate in aggregate_list:
-        if aggregate.availability_zone == availability_zone:
-            aggregates.append(aggregate)
-
-    hosts = []
     # loads hosts from aggregates if not specified
     if not hostname:
-        for aggregate in aggregates:
-            hosts.extend(aggregate.hosts)
+        hosts = sorted({h for _, index in indexes for h in index.all_hosts()})
     else:
-        hosts = hostname
-
-    # unique hosts
-    hosts = list(set(hosts))
-    hosts.sort()
+        if not isinstance(hostname, str):
+            hostname = ','.join(hostname)
+        hosts = sorted(parse_nodes(hostname))
+
+    rows = (
+        dict(row, region=profile)
+        for profile, index in indexes
+        for row in index.matrix(hosts)
+    )
+    labels = ['region', 'aggregate'] if clouds else ['aggregate']
+    if format != 'table':
+        if format == 'csv':
+            rows = (
+                dict(row, **{host: 'X' if row[host] else '' for host in hosts})
+                for row in rows
+            )
+        write_rows(rows, format, labels + hosts)
+        return
 
     # builds table
     header = ["Aggregates"] + hosts
+    if clouds:
+        header = ["Region"] + header
     table = PrettyTable(header)
     table.align["Aggregates"] = 'l'
-    aggregates.sort()
-    for aggregate in aggregates:
-        row = [aggregate.name]
-        for host in hosts:
-            if host in aggregate.hosts:
-                row.append("X")
-            else:
-                row.append("")
-        table.add_row(row)
+    for row in rows:
+        table.add_row(
+            [row[label] for label in labels]
+            + ["X" if row[host] else "" for host in hosts]
+        )
 
     print(table)
 
 
+@task
+@decorators.verbose
+def watch_instances(
+    zone=None,
+    nodes=None,
+    project=None,
+    changes_since=None,
+    interval=WATCH_INTERVAL,
+    polls=None,
+    format='table',
+):
+    """Prints instances as their status, host or task state changes
+
+    :param str zone: Availability zone or availability zone range
+         that the instances are in, e.g. az[1-4,9]
+    :param str nodes: Compute host name or host name range that the
+         instances are in, e.g. cc[2-3,5]
+    :param str project: Project name or id that the instances belong to
+    :param str changes_since: Start from the changes after this ISO 8061
+         time rather than from now, e.g. 2016-03-04T06:27:59Z
+    :param int interval: Seconds between polls
+    :param int polls: Stop after this many polls. Runs until interrupted
+         by default
+    :param str format: Output format, one of table, csv or jsonl
+    """
+    if format not in OUTPUT_FORMATS:
+        error(f"Unknown format {format}, use one of {OUTPUT_FORMATS}")
+    opts = {'all_tenants': True}
+    if changes_since:
+        opts['changes-since'] = changes_since
+    if project:
+        opts['tenant_id'] = keystone.get_project(
+            keystone.client(), project, use_cache=True
+        ).id
+    changes = iter_instance_changes(
+        client(),
+        opts,
+        host_list=parse_nodes(nodes) if nodes else None,
+        az_list=parse_nodes(zone) if zone else None,
+        interval=float(interval),
+        polls=int(polls) if polls else None,
+    )
+    try:
+        if format != 'table':
+            write_rows(changes, format, list(WATCH_COLUMNS))
+            return
+        for change in changes:
+            print(
+                "{updated} {id} {name}: {status} on {host}"
+                " (task {task_state})".format(**change)
+            )
+    except KeyboardInterrupt:
+        pass
+
+
+def iter_instance_changes(
+    client,
+    opts,
+    host_list=None,
+    az_list=None,
+    interval=WATCH_INTERVAL,
+    polls=None,
+):
+    """Yield a row each time a server's status, host or task state changes
+
+    Each poll only asks nova for the servers updated since the latest
+    update seen so far, so an idle cloud costs one empty listing per
+    poll. Deleted servers are included, as changes-since reports them.
+    """
+    opts = dict(opts)
+    if 'changes-since' not in opts:
+        opts['changes-since'] = time.strftime(
+            '%Y-%m-%dT%H:%M:%SZ', time.gmtime()
+        )
+    states = {}
+    for poll in itertools.count():
+        if polls and poll >= polls:
+            return
+        if poll:
+            time.sleep(interval)
+        watermark = opts['changes-since']
+        for page in _iter_marker_pages(client, opts, az_list):
+            for server in page:
+                # changes-since also returns servers updated at that
+                # instant, so the latest one comes back each poll
+                watermark = max(watermark, server.updated)
+                host = getattr(server, 'OS-EXT-SRV-ATTR:host', None)
+                # keep following servers which move off the hosts
+                if (
+                    host_list
+                    and host not in host_list
+                    and server.id not in states
+                ):
+                    continue
+                state = (
+                    server.status,
+                    host,
+                    getattr(server, 'OS-EXT-STS:task_state', None),
+                )
+                if states.get(server.id) == state:
+                    continue
+                states[server.id] = state
+                yield dict(
+                    zip(
+                        WATCH_COLUMNS,
+                        (server.updated, server.id, server.name) + state,
+                    )
+                )
+        opts['changes-since'] = watermark
+
+
+@task
+@decorators.verbose
+def capacity_report(
+    nodes=None,
+    flavors=None,
+    group='host',
+    format='table',
+    cpu_ratio=1.0,
+    ram_ratio=1.0,
+):
+    """Prints the vCPU, RAM and disk usage and free flavor slots of hosts
+
+    :param str nodes: Only report on these hosts, using the list syntax
+      (eg. qh2-rcc[01-10,13])
+    :param str flavors: Comma separated names of the flavors to count
+      free slots for. Defaults to all public flavors
+    :param str group: Report per host or per aggregate
+    :param str format: Output format, one of table, csv or jsonl
+    :param float cpu_ratio: vCPUs scheduled per physical core
+    :param float ram_ratio: RAM scheduled per MB of physical RAM
+    """
+    if format not in OUTPUT_FORMATS:
+        error(f"Unknown format {format}, use one of {OUTPUT_FORMATS}")
+    if group not in ('host', 'aggregate'):
+        error(f"Unknown group {group}, use host or aggregate")
+
+    nova = client()
+    # the three listings don't depend on each other
+    with futures.ThreadPoolExecutor(3) as executor:
+        hypervisors = executor.submit(nova.hypervisors.list)
+        aggregates = executor.submit(nova.aggregates.list)
+        flavor_list = executor.submit(nova.flavors.list)
+    index = AggregateIndex({a.name: a.hosts for a in aggregates.result()})
+    flavor_list = flavor_list.result()
+    if flavors:
+        names = flavors.split(',')
+        by_name = {flavor.name: flavor for flavor in flavor_list}
+        unknown = [name for name in names if name not in by_name]
+        if unknown:
+            error(f"Unknown flavors: {', '.join(unknown)}")
+        flavor_list = [by_name[name] for name in names]
+    hypervisors = hypervisors.result()
+    if nodes:
+        hosts = parse_nodes(nodes)
+        hypervisors = [h for h in hypervisors if h.service['host'] in hosts]
+
+    columns, rows = capacity_rows(
+        hypervisors,
+        index,
+        flavor_list,
+        group,
+        float(cpu_ratio),
+        float(ram_ratio),
+    )
+    if format != 'table':
+        write_rows(rows, format, columns)
+        return
+
+    table = PrettyTable(columns)
+    table.align = 'r'
+    table.align[group] = 'l'
+    for row in rows:
+        table.add_row([row[column] for column in columns])
+    print(table)
+
+
+def capacity_rows(hypervisors, index, flavors, group, cpu_ratio, ram_ratio):
+    """Work out the usage and free flavor slots of each host or aggregate
+
+    The hypervisor fields are held as columns and each figure is
+    computed down a whole column at once, so a report covers thousands
+    of hosts and dozens of flavors in one pass per column.
+
+    :returns: The column names and a list of row dicts
+    """
+    hosts = [h.service['host'] for h in hypervisors]
+    up = [h.state == 'up' and h.status == 'enabled' for h in hypervisors]
+    totals = {
+        'vcpus': [h.vcpus for h in hypervisors],
+        'vcpus_used': [h.vcpus_used for h in hypervisors],
+        'memory_mb': [h.memory_mb for h in hypervisors],
+        'memory_mb_used': [h.memory_mb_used for h in hypervisors],
+        'local_gb': [h.local_gb for h in hypervisors],
+        'local_gb_used': [h.local_gb_used for h in hypervisors],
+    }
+    free_vcpus = [
+        max(0, int(total * cpu_ratio) - used) if ok else 0
+        for total, used, ok in zip(totals['vcpus'], totals['vcpus_used'], up)
+    ]
+    free_ram = [
+        max(0, int(total * ram_ratio) - used) if ok else 0
+        for total, used, ok in zip(
+            totals['memory_mb'], totals['memory_mb_used'], up
+        )
+    ]
+    free_disk = [
+        max(0, total - used) if ok else 0
+        for total, used, ok in zip(
+            totals['local_gb'], totals['local_gb_used'], up
+        )
+    ]
+    slots = {}
+    for flavor in flavors:
+        # a flavor with no root disk only needs vCPUs and RAM
+        disk = free_disk if flavor.disk else itertools.repeat(None)
+        slots[flavor.name] = [
+            min(
+                cpu // flavor.vcpus,
+                ram // flavor.ram,
+                d // flavor.disk if d is not None else cpu,
+            )
+            for cpu, ram, d in zip(free_vcpus, free_ram, disk)
+        ]
+
+    # each group is the list of hypervisor positions summed into a row
+    if group == 'host':
+        groups = {host: [i] for i, host in enumerate(hosts)}
+    else:
+        groups = {}
+        for i, host in enumerate(hosts):
+            for name in index.aggregates.get(host, ['(none)']):
+                groups.setdefault(name, []).append(i)
+
+    rows = []
+    for name in sorted(groups):
+        members = groups[name]
+        row = {group: name, 'hosts': len(members)}
+        for field, values in totals.items():
+            row[field] = sum(values[i] for i in members)
+        row['vcpu_util'] = _percent(
+            row['vcpus_used'], row['vcpus'] * cpu_ratio
+        )
+        row['ram_util'] = _percent(
+            row['memory_mb_used'], row['memory_mb'] * ram_ratio
+        )
+        row['disk_util'] = _percent(row['local_gb_used'], row['local_gb'])
+        for flavor, values in slots.items():
+            row[flavor] = sum(values[i] for i in members)
+        rows.append(row)
+
+    columns = (
+        [group, 'hosts']
+        + list(totals)
+        + ['vcpu_util', 'ram_util', 'disk_util']
+        + list(slots)
+    )
+    return columns, rows
+
+
+def _percent(used, total):
+    return round(100.0 * used / total, 1) if total else 0.0
+
+
 @task
 @decorators.verbose
 def list_instances(
@@ -593,6 +2403,18 @@ def list_instances(
     limit=None,
     changes_since=None,
     scenario=None,
+    workers=DEFAULT_WORKERS,
+    max_age=None,
+    format='table',
+    columns=None,
+    page_size=None,
+    checkpoint=None,
+    partitions=None,
+    raw=False,
+    db=False,
+    use_neutron=False,
+    clouds=None,
+    zone_pushdown=False,
 ):
     """Prints a pretty table of instances based on specific conditions
 
@@ -600,11 +2422,13 @@ def list_instances(
          that the instances are in, e.g. az[1-4,9]
     :param str nodes: Compute host name or host neme range that the
          instances are in, e.g. cc[2-3,5]
-    :param str project: Project name or id that the instances belong to
-    :param str user: User name or id that the instances belong to
+    :param str project: Project names or ids that the instances belong
+         to, comma separated or in a file with one per line
+    :param str user: User names or ids that the instances belong to,
+         comma separated or in a file with one per line
     :param str status: Instances status. Use 'ALL' to list all instances
-    :param str ip: Ip address or ip address range that instances are in,
-         e.g. 192.168.122.[124-127]
+    :param str ip: Ip address, ip address range or CIDR that instances
+         are in, e.g. 192.168.122.[124-127] or 10.0.0.0/16
     :param str image: Image id that the instances are launched based on
     :param str limit: Number of returned instances
     :param str changes_since: List only instances changed after a certain
@@ -612,12 +2436,61 @@ def list_instances(
          time. e.g. 2016-03-04T06:27:59Z
     :param str scenario: List only instances which match with specific
          scenario checking, available ones are ["compute_failure"]
+    :param int workers: Number of concurrent API requests to use when
+         querying a range of compute hosts or checking scenarios
+    :param int max_age: Answer from the local instance inventory in
+         ~/.cache/hivemind, refreshing it first if it is older than this
+         many seconds. By default the Nova API is queried directly
+    :param str format: Output format, one of table, csv or jsonl. csv and
+         jsonl rows are written as soon as each instance is extracted
+    :param str columns: Comma separated list of the columns to output,
+         e.g. id,host,email. Defaults to all of them
+    :param str page_size: Number of instances to request per page, or
+         'auto' to adapt it to how long each page takes to fetch
+    :param str checkpoint: File to record the listing progress in, for
+         csv and jsonl output. If a listing fails part way, rerunning
+         it with the same checkpoint carries on after the last instance
+         written
+    :param int partitions: Split the listing into this many update time
+         windows and fetch them concurrently with the workers. Needs
+         compute API 2.66 for the changes-before filter
+    :param bool raw: Read the servers straight from the API's JSON,
+         skipping novaclient's objects, to save time and memory on
+         large listings
+    :param bool db: Read the instances from the nova database set up
+         in the hivemind config rather than the API, best pointed at a
+         read replica
+    :param bool use_neutron: Find the instances on ip through their
+         neutron ports instead of checking every instance's addresses
+    :param str clouds: Comma separated cloud profiles to list the
+         instances of concurrently, each row tagged with its region.
+         See cloud_clients for how profiles are configured. Each cloud
+         keeps its own inventory and checkpoint, and db, use_neutron,
+         project and user can't be used with it
+    :param bool zone_pushdown: Have nova filter on zone, which is faster
+         but misses the instances booted without naming a zone
     """
-    novaclient = client()
+    if format not in OUTPUT_FORMATS:
+        error(f"Unknown format {format}, use one of {OUTPUT_FORMATS}")
+    if checkpoint and format == 'table':
+        error("A checkpoint needs csv or jsonl output")
+    if clouds and (db or use_neutron):
+        error("db and use_neutron only reach the default cloud, drop clouds")
+    if clouds and (project or user):
+        # owners are looked up in, and cached from, the default keystone
+        error("project and user can't be used with clouds")
+    if columns:
+        columns = columns.split(',')
+        unknown = set(columns) - set(ServerInfo.__slots__)
+        if unknown:
+            error(f"Unknown columns: {', '.join(sorted(unknown))}")
+    else:
+        columns = list(ServerInfo.__slots__)
+
+    version = CHANGES_BEFORE_VERSION if partitions else '2.1'
     if status == 'ALL':
         status = None
-    result = all_servers(
-        novaclient,
+    listing = dict(
         zone=zone,
         host=nodes,
         status=status,
@@ -627,26 +2500,124 @@ def list_instances(
         user=user,
         limit=limit,
         changes_since=changes_since,
+        workers=workers,
+        max_age=max_age,
+        page_size=page_size,
+        checkpoint=checkpoint,
+        partitions=partitions,
+        raw=raw,
+        db=db_connect() if db else None,
+        use_neutron=use_neutron,
+        zone_pushdown=zone_pushdown,
     )
+    if clouds:
+        return _list_clouds_instances(
+            clouds, version, listing, format, columns, scenario
+        )
+
+    novaclient = client(version=version)
+    if format != 'table':
+        # keep stdout clean for other tools, so no spinners or messages
+        cp = Checkpoint(checkpoint) if checkpoint else None
+        with cp or contextlib.nullcontext():
+            servers = iter_servers(novaclient, **dict(listing, checkpoint=cp))
+            rows = iter_servers_info(servers, keystone.client())
+            if scenario:
+                func = globals()["_scenario_" + scenario]
+                rows = iter_scenario_matches(
+                    rows,
+                    func,
+                    _timeout_client(novaclient, SCENARIO_TIMEOUT),
+                    changes_since,
+                    workers=workers,
+                )
+            write_rows(rows, format, columns, written=cp and cp.written)
+        return
+
+    # stream the servers into the extraction so only one page of
+    # novaclient Server objects is held in memory at any time
+    servers = iter_servers(novaclient, **listing)
+
+    result = extract_servers_info(servers, keystone.client())
     if not result:
         print("No instances found!")
         sys.exit(0)
-    result = extract_servers_info(result, keystone.client())
 
     if scenario:
         func = globals()["_scenario_" + scenario]
-        result = match_scenario(result, func, novaclient, changes_since)
+        result = match_scenario(
+            result,
+            func,
+            _timeout_client(novaclient, SCENARIO_TIMEOUT),
+            changes_since,
+            workers=workers,
+        )
         if not result:
             print(f"No {scenario} instances found!")
             sys.exit(0)
 
     print("\n")
-    header = None
+    table = PrettyTable(columns)
     for inst in result:
-        if not header:
-            header = inst.keys()
-            table = PrettyTable(header)
-        table.add_row(inst.values())
+        table.add_row([inst[column] for column in columns])
+    print(table)
+    print("number of instances:", len(result))
+    return result
+
+
+def _list_clouds_instances(
+    clouds, version, listing, format, columns, scenario
+):
+    checkpoints = {}
+
+    def cloud_rows(profile, novaclient, ksclient):
+        # each cloud keeps its own inventory and checkpoint
+        if listing['checkpoint']:
+            checkpoints[profile] = Checkpoint(
+                _cloud_path(listing['checkpoint'], profile)
+            )
+        servers = iter_servers(
+            novaclient,
+            **dict(
+                listing,
+                inventory_path=_cloud_path(INVENTORY_PATH, profile),
+                checkpoint=checkpoints.get(profile),
+            ),
+        )
+        rows = iter_servers_info(servers, ksclient)
+        if scenario:
+            func = globals()["_scenario_" + scenario]
+            rows = iter_scenario_matches(
+                rows,
+                func,
+                _timeout_client(novaclient, SCENARIO_TIMEOUT),
+                listing['changes_since'],
+                workers=listing['workers'],
+            )
+        return [dict(region=profile, **row.to_dict()) for row in rows]
+
+    columns = ['region'] + columns
+    result = [
+        row
+        for profile, rows in fan_out(clouds, cloud_rows, version)
+        for row in rows
+    ]
+    if format != 'table':
+        with contextlib.ExitStack() as stack:
+            for checkpoint in checkpoints.values():
+                stack.enter_context(checkpoint)
+            write_rows(
+                result,
+                format,
+                columns,
+                written=checkpoints
+                and (lambda row: checkpoints[row['region']].written(row)),
+            )
+        return
+
+    table = PrettyTable(columns)
+    for row in result:
+        table.add_row([row[column] for column in columns])
     print(table)
     print("number of instances:", len(result))
     return result
@@ -1,14 +1,71 @@
+import hashlib
+import os
+import threading
+
 from fabric.api import task
 import swiftclient.client as swift_client
 
 from hivemind_contrib import keystone
 
+OBJECT_CACHE_PATH = '~/.cache/hivemind/swift'
+
+_session = None
+_session_lock = threading.Lock()
+_connections = threading.local()
+
 
 def client():
     sess = keystone.get_session()
     return swift_client.Connection(session=sess)
 
 
+def connection():
+    """Return this thread's Swift connection
+
+    The Keystone session is created once per process and shared, so only
+    the first connection authenticates. swiftclient connections are not
+    thread safe, so each thread gets its own.
+    """
+    global _session
+    if not hasattr(_connections, 'conn'):
+        with _session_lock:
+            if _session is None:
+                _session = keystone.get_session()
+        _connections.conn = swift_client.Connection(session=_session)
+    return _connections.conn
+
+
+def get_object_cached(container, obj, cache_path=OBJECT_CACHE_PATH):
+    """Return the contents of an object, using a local ETag keyed cache
+
+    The object's ETag is checked with a HEAD request and the contents
+    are only downloaded when no copy with that ETag is cached yet.
+    """
+    conn = connection()
+    cache_path = os.path.expanduser(cache_path)
+    etag = conn.head_object(container, obj)['etag'].strip('"')
+    path = os.path.join(cache_path, etag)
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+    headers, contents = conn.get_object(container, obj)
+    etag = headers['etag'].strip('"')
+    # large object manifests have an ETag which is not the contents md5
+    if 'x-object-manifest' in headers or 'x-static-large-object' in headers:
+        return contents
+    if hashlib.md5(contents).hexdigest() != etag:
+        return contents
+    os.makedirs(cache_path, exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(contents)
+    os.replace(tmp, os.path.join(cache_path, etag))
+    return contents
+
+
 def size_to_bytes(num):
     units = ['B', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB']
     if num[-2:].isalpha():
@@ -0,0 +1,338 @@
+"""Offline benchmark for the nova instance listing pipeline
+
+Runs nova.list_instances (all_servers, extract_servers_info and the
+output rendering) against a local stand-in for the Nova servers/detail
+and Keystone project/user endpoints, so the listing path can be measured
+without touching a real cloud. For each cloud size it reports the number
+of API calls made, the wall time and the peak Python memory. The fake
+endpoints run in a child process so their memory isn't counted.
+
+Run with e.g.:
+
+    python -m hivemind_contrib.tests.benchmark --servers 1000,10000,100000
+"""
+
+import argparse
+import collections
+import contextlib
+import http.server
+import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+import tracemalloc
+from unittest import mock
+from urllib import parse
+import uuid
+
+from keystoneauth1 import noauth
+from keystoneauth1 import session
+from keystoneclient.v3 import client as keystone_client
+from novaclient import client as nova_client
+
+from hivemind_contrib import keystone
+from hivemind_contrib import nova
+
+
+FLAVOR = {
+    'original_name': 'm3.small',
+    'vcpus': 2,
+    'ram': 4096,
+    'disk': 30,
+    'ephemeral': 0,
+    'swap': 0,
+    'extra_specs': {},
+}
+
+
+class FakeCloud:
+    """Generated servers, projects and users for the fake endpoints"""
+
+    def __init__(self, servers=1000, projects=100, hosts=None, zones=4):
+        hosts = hosts or max(1, servers // 40)
+        self.projects = [
+            {'id': uuid.UUID(int=i).hex, 'name': f'project-{i}'}
+            for i in range(projects)
+        ]
+        self.users = [
+            {
+                'id': uuid.UUID(int=i + 1 << 64).hex,
+                'name': f'user-{i}',
+                'email': f'user-{i}@example.com',
+                'full_name': f'User {i}',
+                'enabled': True,
+            }
+            for i in range(projects * 2)
+        ]
+        self.servers = [self._server(i, hosts, zones) for i in range(servers)]
+        self.index = {s['id']: i for i, s in enumerate(self.servers)}
+        self.projects_by_id = {p['id']: p for p in self.projects}
+        self.users_by_id = {u['id']: u for u in self.users}
+
+    def _server(self, i, hosts, zones):
+        project = i % len(self.projects)
+        return {
+            'id': str(uuid.UUID(int=i + 2 << 64)),
+            'name': f'server-{i}',
+            'status': 'ACTIVE',
+            'flavor': {'id': '885227de-b7ee-42af-a209-2f1ff59bc330'},
+            'image': {'id': 'e0c2dd33-5b3e-4a7f-b2b1-9c1ac1bdf6e1'},
+            'user_id': self.users[project * 2]['id'],
+            'tenant_id': self.projects[project]['id'],
+            'metadata': {},
+            # spread the updates over a few years for partitioned scans
+            'updated': time.strftime(
+                '%Y-%m-%dT%H:%M:%SZ', time.gmtime(1.45e9 + i * 997)
+            ),
+            'OS-EXT-SRV-ATTR:host': f'cc{i % hosts + 1:04d}',
+            'OS-EXT-AZ:availability_zone': f'az{i % zones + 1}',
+            'addresses': {
+                'public': [
+                    {
+                        'addr': f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}',
+                        'OS-EXT-IPS:type': 'fixed',
+                    }
+                ]
+            },
+        }
+
+    def list_servers(self, query, page_size):
+        """Filter and page the servers like nova does for admins"""
+        servers = self.servers
+        if 'marker' in query:
+            servers = servers[self.index[query['marker']] + 1 :]
+        for key, field in (
+            ('host', 'OS-EXT-SRV-ATTR:host'),
+            ('status', 'status'),
+            ('tenant_id', 'tenant_id'),
+            ('user_id', 'user_id'),
+        ):
+            if key in query:
+                servers = [s for s in servers if s[field] == query[key]]
+        if 'changes-since' in query:
+            since = query['changes-since']
+            servers = [s for s in servers if s['updated'] >= since]
+        if 'changes-before' in query:
+            before = query['changes-before']
+            servers = [s for s in servers if s['updated'] <= before]
+        if 'availability_zone' in query:
+            regex = re.compile(query['availability_zone'])
+            servers = [
+                s
+                for s in servers
+                if regex.search(s['OS-EXT-AZ:availability_zone'])
+            ]
+        if 'ip' in query:
+            # nova hands ip to neutron as a substring of the fixed IPs
+            servers = [
+                s
+                for s in servers
+                if any(
+                    query['ip'] in a['addr']
+                    and a['OS-EXT-IPS:type'] == 'fixed'
+                    for addrs in s['addresses'].values()
+                    for a in addrs
+                )
+            ]
+        limit = min(int(query.get('limit', page_size)), page_size)
+        return servers[:limit]
+
+
+class FakeOpenStack:
+    """A local HTTP server answering as Nova and Keystone"""
+
+    def __init__(self, cloud, page_size=1000, latency=0.0):
+        self.cloud = cloud
+        self.page_size = page_size
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        handler = type('Handler', (_Handler,), {'fake': self})
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), handler
+        )
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, kind):
+        with self.lock:
+            self.calls[kind] += 1
+
+    def nova(self, version='2.1'):
+        sess = session.Session(
+            auth=noauth.NoAuth(endpoint=self.url + '/compute/v2.1')
+        )
+        return nova_client.Client(version, session=sess)
+
+    def keystone(self):
+        sess = session.Session(
+            auth=noauth.NoAuth(endpoint=self.url + '/identity/v3')
+        )
+        return keystone_client.Client(session=sess)
+
+
+class FakeOpenStackProcess(FakeOpenStack):
+    """A FakeOpenStack served from a child process
+
+    Keeps the fake server's allocations, like the JSON encoding of every
+    page, out of the benchmark's memory measurements. The API call counts
+    are read back from the child when it stops.
+    """
+
+    def __init__(self, cloud, page_size=1000, latency=0.0):
+        self.args = (cloud, page_size, latency)
+        self.calls = collections.Counter()
+
+    def __enter__(self):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_serve, args=self.args + (child,), daemon=True
+        )
+        self.process.start()
+        self.url = self.conn.recv()
+        return self
+
+    def __exit__(self, *exc):
+        self.conn.send('stop')
+        self.calls.update(self.conn.recv())
+        self.process.join()
+
+
+def _serve(cloud, page_size, latency, conn):
+    with FakeOpenStack(cloud, page_size, latency) as fake:
+        conn.send(fake.url)
+        conn.recv()
+        conn.send(dict(fake.calls))
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    fake = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = parse.urlsplit(self.path)
+        query = dict(parse.parse_qsl(url.query))
+        parts = url.path.strip('/').split('/')
+        time.sleep(self.fake.latency)
+        cloud = self.fake.cloud
+
+        if parts[:3] == ['compute', 'v2.1', 'servers']:
+            self.fake.count('servers')
+            servers = cloud.list_servers(query, self.fake.page_size)
+            version = self.headers.get('X-OpenStack-Nova-API-Version', '2.1')
+            if tuple(map(int, version.split('.'))) >= (2, 47):
+                # the flavor is embedded by name from 2.47 on
+                servers = [dict(s, flavor=FLAVOR) for s in servers]
+            body = {'servers': servers}
+        elif parts[:2] == ['identity', 'v3'] and len(parts) > 2:
+            kind = parts[2]
+            self.fake.count(kind)
+            resources = {
+                'projects': cloud.projects_by_id,
+                'users': cloud.users_by_id,
+            }[kind]
+            if len(parts) > 3:
+                if parts[3] not in resources:
+                    return self._reply(404, {'error': {'code': 404}})
+                body = {kind[:-1]: resources[parts[3]]}
+            else:
+                body = {kind: list(resources.values())}
+        else:
+            return self._reply(404, {'error': {'code': 404}})
+        self._reply(200, body)
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def run(
+    servers=1000,
+    projects=100,
+    page_size=1000,
+    latency=0.0,
+    output_format='table',
+    **kwargs,
+):
+    """Time one list_instances run against a fake cloud
+
+    Any extra keyword arguments are passed on to list_instances.
+    """
+    cloud = FakeCloud(servers=servers, projects=projects)
+    with FakeOpenStackProcess(cloud, page_size, latency) as fake:
+        keystone.project_cache.clear()
+        keystone.user_cache.clear()
+        tracemalloc.start()
+        start = time.perf_counter()
+        with (
+            mock.patch.object(nova, 'client', fake.nova),
+            mock.patch.object(keystone, 'client', fake.keystone),
+            open(os.devnull, 'w') as devnull,
+            contextlib.redirect_stdout(devnull),
+        ):
+            result = nova.list_instances(
+                status='ALL', format=output_format, **kwargs
+            )
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {
+        'servers': servers,
+        'instances': len(result) if result is not None else None,
+        'api_calls': dict(fake.calls),
+        'seconds': elapsed,
+        'peak_mb': peak / 2**20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--servers', default='1000,10000,100000')
+    parser.add_argument('--projects', type=int, default=None)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument(
+        '--format', default='table', choices=nova.OUTPUT_FORMATS
+    )
+    parser.add_argument('--partitions', type=int, default=None)
+    parser.add_argument('--raw', action='store_true')
+    args = parser.parse_args()
+
+    for count in [int(n) for n in args.servers.split(',')]:
+        result = run(
+            servers=count,
+            projects=args.projects or max(1, count // 4),
+            page_size=args.page_size,
+            latency=args.latency,
+            output_format=args.format,
+            partitions=args.partitions,
+            raw=args.raw,
+        )
+        calls = ', '.join(
+            f'{kind}={n}' for kind, n in sorted(result['api_calls'].items())
+        )
+        print(
+            f"{count:>7} servers: {result['seconds']:8.2f}s "
+            f"peak {result['peak_mb']:8.1f}MB  api calls: {calls}"
+        )
+
+
+if __name__ == '__main__':
+    main()
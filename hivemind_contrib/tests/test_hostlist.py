@@ -0,0 +1,94 @@
+import timeit
+import unittest
+
+from hivemind_contrib import hostlist
+
+
+class HostListTestCase(unittest.TestCase):
+    def assertHosts(self, expected, expression):
+        hosts = hostlist.HostList(expression)
+        self.assertEqual(sorted(expected), sorted(hosts))
+        self.assertEqual(len(expected), len(hosts))
+        for host in expected:
+            self.assertIn(host, hosts)
+
+    def test_single(self):
+        self.assertHosts(['qh2-rcc1'], 'qh2-rcc1')
+
+    def test_comma(self):
+        self.assertHosts(['cc5', 'cc6', 'cc7'], 'cc5,cc6, cc7')
+
+    def test_range(self):
+        self.assertHosts(
+            ['qh2-rcc112', 'qh2-rcc113', 'qh2-rcc114', 'qh2-rcc115'],
+            'qh2-rcc[112-114,115]',
+        )
+
+    def test_padding(self):
+        hosts = hostlist.HostList('cc[08-10]')
+        self.assertHosts(['cc08', 'cc09', 'cc10'], 'cc[08-10]')
+        self.assertNotIn('cc8', hosts)
+        self.assertNotIn('cc010', hosts)
+
+    def test_suffix_and_literals(self):
+        self.assertHosts(['az1-a', 'az2-a', 'azx-a', 'db'], 'az[1-2,x]-a,db')
+
+    def test_duplicates_counted_once(self):
+        self.assertHosts(['cc1', 'cc2', 'cc3', 'cc4'], 'cc[1-3],cc[2-4],cc3')
+        self.assertHosts(
+            ['cc8', 'cc9', 'cc10', 'cc08', 'cc09'], 'cc[8-10,08-10]'
+        )
+
+    def test_multiple_groups(self):
+        self.assertHosts(['r1-n1', 'r1-n2', 'r2-n1', 'r2-n2'], 'r[1-2]-n[1-2]')
+
+    def test_adjacent_groups(self):
+        self.assertHosts(
+            [f'cc{a}{b}' for a in (1, 2) for b in range(10, 21)],
+            'cc[1-2][10-20]',
+        )
+        self.assertNotIn('cc310', hostlist.HostList('cc[1-2][10-20]'))
+
+    def test_not_member(self):
+        hosts = hostlist.HostList('cc[1-5]')
+        self.assertNotIn('cc6', hosts)
+        self.assertNotIn('dd1', hosts)
+        self.assertNotIn('cc', hosts)
+        self.assertNotIn(None, hosts)
+
+    def test_large_range_not_expanded(self):
+        hosts = hostlist.HostList('cc[0001-9999],az[1-50],big[1-1000000000]')
+        self.assertIn('cc0042', hosts)
+        self.assertIn('big999999999', hosts)
+        self.assertNotIn('cc42', hosts)
+        self.assertEqual(10**9, len(hostlist.HostList('big[1-1000000000]')))
+
+    def test_compress(self):
+        hosts = ['cc1', 'cc2', 'cc3', 'cc5', 'cc9', 'db01', 'db02', 'x']
+        expression = hostlist.compress(hosts)
+        self.assertEqual('cc[1-3,5,9],db[01-02],x', expression)
+        self.assertEqual(sorted(hosts), sorted(hostlist.HostList(expression)))
+
+    def test_compress_padding(self):
+        hosts = ['cc08', 'cc09', 'cc10', 'cc9', 'cc10-a']
+        expression = hostlist.compress(hosts)
+        self.assertEqual(sorted(hosts), sorted(hostlist.HostList(expression)))
+
+
+def benchmark(number=1000):
+    """Micro-benchmark membership tests against the old eager expansion
+
+    Run with: python -m hivemind_contrib.tests.test_hostlist
+    """
+    expression = 'cc[0001-9999],az[1-50]'
+    parse = timeit.timeit(lambda: hostlist.HostList(expression), number=number)
+    hosts = hostlist.HostList(expression)
+    lookup = timeit.timeit(lambda: 'cc5000' in hosts, number=number)
+    expand = timeit.timeit(lambda: set(hosts), number=10) / 10
+    print(f'parse {expression}: {parse / number * 1e6:.1f}us')
+    print(f'membership test: {lookup / number * 1e6:.1f}us')
+    print(f'full expansion (as parse_nodes used to): {expand * 1e3:.1f}ms')
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -69,3 +69,66 @@ class GetSessionTestCase(unittest.TestCase):
         loader = mock_loading.get_plugin_loader.return_value
         opts = loader.load_from_options.call_args.kwargs
         self.assertEqual('legacy-proj', opts['project_name'])
+
+
+class PrefetchTestCase(unittest.TestCase):
+    def setUp(self):
+        for name in ('project_tried', 'user_tried'):
+            patcher = mock.patch.object(keystone, name, set())
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _project(self, project_id):
+        project = mock.Mock()
+        project.id = project_id
+        return project
+
+    @mock.patch.dict('hivemind_contrib.keystone.project_cache', clear=True)
+    def test_few_missing_uses_get(self):
+        ks = mock.Mock(version='v3')
+        ks.projects.get.side_effect = self._project
+        keystone.project_cache['p1'] = self._project('p1')
+
+        keystone.prefetch_projects(ks, ['p1', 'p2', 'p3'])
+
+        ks.projects.list.assert_not_called()
+        self.assertEqual(2, ks.projects.get.call_count)
+        self.assertEqual({'p1', 'p2', 'p3'}, set(keystone.project_cache))
+
+    @mock.patch.dict('hivemind_contrib.keystone.project_cache', clear=True)
+    @mock.patch('hivemind_contrib.keystone.PREFETCH_LIST_THRESHOLD', 1)
+    def test_many_missing_uses_list(self):
+        ks = mock.Mock(version='v3')
+        ks.projects.list.return_value = [
+            self._project(f'p{i}') for i in range(5)
+        ]
+
+        keystone.prefetch_projects(ks, ['p1', 'p2', 'p3'])
+
+        ks.projects.get.assert_not_called()
+        self.assertEqual(5, len(keystone.project_cache))
+
+    @mock.patch.dict('hivemind_contrib.keystone.project_cache', clear=True)
+    @mock.patch('hivemind_contrib.keystone.PREFETCH_LIST_THRESHOLD', 1)
+    def test_list_runs_once(self):
+        ks = mock.Mock(version='v3')
+        ks.projects.list.return_value = [self._project('p1')]
+        ks.projects.get.side_effect = keystone.NotFound()
+
+        # gone1 and gone2 are deleted projects which the list won't return
+        keystone.prefetch_projects(ks, ['p1', 'gone1', 'gone2'])
+        keystone.prefetch_projects(ks, ['gone1', 'gone2'])
+        keystone.prefetch_projects(ks, ['gone3', 'gone4'])
+
+        ks.projects.list.assert_called_once_with()
+        # only the ids not seen before are looked for again
+        self.assertEqual(2, ks.projects.get.call_count)
+
+    @mock.patch.dict('hivemind_contrib.keystone.user_cache', clear=True)
+    def test_unknown_user_skipped(self):
+        ks = mock.Mock()
+        ks.users.get.side_effect = keystone.NotFound()
+
+        keystone.prefetch_users(ks, ['u1'])
+
+        self.assertEqual({}, keystone.user_cache)
@@ -0,0 +1,78 @@
+import ipaddress
+import unittest
+from unittest import mock
+
+from hivemind_contrib import neutron
+
+
+def port(port_id, device_id, *ips, owner='compute:nova'):
+    return {
+        'id': port_id,
+        'device_id': device_id,
+        'device_owner': owner,
+        'fixed_ips': [{'ip_address': ip} for ip in ips],
+    }
+
+
+class FindDeviceIdsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = mock.Mock()
+        self.client.list_floatingips.return_value = {'floatingips': []}
+
+    def test_addresses(self):
+        self.client.list_ports.side_effect = [
+            {
+                'ports': [
+                    port('p1', 'vm1', '10.0.0.1'),
+                    port('p2', 'router', '10.0.0.2', owner='network:router'),
+                ]
+            },
+            {'ports': [port('p3', 'vm3', '10.0.0.9')]},
+        ]
+        self.client.list_floatingips.return_value = {
+            'floatingips': [
+                {'floating_ip_address': '203.0.113.5', 'port_id': 'p3'}
+            ]
+        }
+        ids = neutron.find_device_ids(
+            self.client,
+            [
+                ipaddress.ip_address('10.0.0.1'),
+                ipaddress.ip_address('10.0.0.2'),
+            ],
+        )
+        self.assertEqual({'vm1', 'vm3'}, ids)
+        first = self.client.list_ports.call_args_list[0].kwargs
+        self.assertEqual(
+            ['ip_address=10.0.0.1', 'ip_address=10.0.0.2'], first['fixed_ips']
+        )
+        self.client.list_ports.assert_called_with(id=['p3'])
+
+    @mock.patch.object(neutron, 'FILTER_BATCH', 2)
+    def test_batches(self):
+        self.client.list_ports.return_value = {'ports': []}
+        addresses = [ipaddress.ip_address(f'10.0.0.{i}') for i in range(5)]
+        neutron.find_device_ids(self.client, addresses)
+        self.assertEqual(3, self.client.list_ports.call_count)
+        self.assertEqual(3, self.client.list_floatingips.call_count)
+
+    def test_networks(self):
+        self.client.list_subnets.return_value = {
+            'subnets': [
+                {'id': 's1', 'cidr': '10.0.0.0/24'},
+                {'id': 's2', 'cidr': '192.168.0.0/24'},
+            ]
+        }
+        self.client.list_ports.return_value = {
+            'ports': [
+                port('p1', 'vm1', '10.0.0.5'),
+                port('p2', 'vm2', '10.0.0.200'),
+            ]
+        }
+        ids = neutron.find_device_ids(
+            self.client, networks=[ipaddress.ip_network('10.0.0.0/25')]
+        )
+        self.assertEqual({'vm1'}, ids)
+        self.client.list_ports.assert_called_once_with(
+            fixed_ips=['subnet_id=s1']
+        )
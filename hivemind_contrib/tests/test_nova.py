@@ -0,0 +1,1556 @@
+import datetime
+import io
+import itertools
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import dateutil.tz
+from novaclient import api_versions
+from novaclient import exceptions as nova_exceptions
+from novaclient.v2 import servers as nova_servers
+import sqlalchemy
+
+from hivemind_contrib import nova
+from hivemind_contrib.tests import benchmark
+
+
+class FakeServer:
+    def __init__(
+        self,
+        server_id,
+        host='cc1',
+        zone='melbourne-qh2',
+        addresses=None,
+        **kwargs,
+    ):
+        self.id = server_id
+        self.name = f'server-{server_id}'
+        self.status = 'ACTIVE'
+        self.addresses = addresses or {}
+        self.metadata = {}
+        setattr(self, 'OS-EXT-SRV-ATTR:host', host)
+        setattr(self, 'OS-EXT-AZ:availability_zone', zone)
+        self.updated = '2016-03-04T06:27:59Z'
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+class AllServersHostListTestCase(unittest.TestCase):
+    def setUp(self):
+        self.servers = {
+            'cc1': [FakeServer('a', host='cc1'), FakeServer('b', host='cc1')],
+            'cc2': [FakeServer('c', host='cc2')],
+            'cc3': [FakeServer('d', host='cc3', zone='other')],
+        }
+        self.client = mock.Mock()
+        self.client.servers.list.side_effect = lambda search_opts: (
+            self.servers.get(search_opts['host'], [])
+        )
+
+    def test_results_in_host_order(self):
+        result = nova.all_servers(self.client, host='cc[3,1-2]', workers=3)
+        self.assertEqual(['a', 'b', 'c', 'd'], [s.id for s in result])
+        self.assertEqual(3, self.client.servers.list.call_count)
+
+    def test_zone_filter_pushed_down(self):
+        nova.all_servers(
+            self.client,
+            host='cc[1-3]',
+            zone='melbourne-qh2',
+            zone_pushdown=True,
+        )
+        for call in self.client.servers.list.call_args_list:
+            opts = call.kwargs['search_opts']
+            self.assertEqual(r'^melbourne\-qh2$', opts['availability_zone'])
+
+    def test_zone_filter_client_side(self):
+        # the zone nova reports, which for instances booted without one
+        # comes from their host rather than the zone column nova filters
+        result = nova.all_servers(self.client, host='cc[1-3]', zone='other')
+        self.assertEqual(['d'], [s.id for s in result])
+        for call in self.client.servers.list.call_args_list:
+            self.assertNotIn('availability_zone', call.kwargs['search_opts'])
+
+    def test_limit(self):
+        result = nova.all_servers(
+            self.client, host='cc[1-3]', limit=2, workers=1
+        )
+        self.assertEqual(['a', 'b'], [s.id for s in result])
+
+
+class IterServersTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pages = [
+            [FakeServer('a'), FakeServer('b')],
+            [FakeServer('c'), FakeServer('d')],
+            [],
+        ]
+        self.client = mock.Mock()
+        self.client.servers.list.side_effect = self.pages
+
+    def test_pages_fetched_lazily(self):
+        servers = nova.iter_servers(self.client)
+        self.assertEqual('a', next(servers).id)
+        self.assertEqual(1, self.client.servers.list.call_count)
+        self.assertEqual(['b', 'c', 'd'], [s.id for s in servers])
+        self.assertEqual(3, self.client.servers.list.call_count)
+        opts = self.client.servers.list.call_args.kwargs['search_opts']
+        self.assertEqual('d', opts['marker'])
+
+    def test_limit_stops_paging(self):
+        result = list(nova.iter_servers(self.client, limit=2))
+        self.assertEqual(['a', 'b'], [s.id for s in result])
+        self.assertEqual(1, self.client.servers.list.call_count)
+
+    def test_all_servers(self):
+        result = nova.all_servers(self.client, zone='melbourne-qh2')
+        self.assertEqual(['a', 'b', 'c', 'd'], [s.id for s in result])
+
+
+class ExtractServersInfoTestCase(unittest.TestCase):
+    def _server(self, server_id, user, project):
+        return FakeServer(
+            server_id,
+            flavor={'id': 'f1'},
+            user_id=user,
+            tenant_id=project,
+        )
+
+    @mock.patch('hivemind_contrib.nova.keystone')
+    def test_prefetch_per_batch(self, mock_keystone):
+        servers = [
+            self._server('a', 'u1', 'p1'),
+            self._server('b', 'u2', 'p1'),
+            self._server('c', 'u1', 'p2'),
+        ]
+        ksclient = mock.Mock()
+
+        result = list(
+            nova.iter_servers_info(servers, ksclient=ksclient, batch_size=2)
+        )
+
+        self.assertEqual(['a', 'b', 'c'], [r['id'] for r in result])
+        mock_keystone.prefetch_projects.assert_has_calls(
+            [mock.call(ksclient, {'p1'}), mock.call(ksclient, {'p2'})]
+        )
+        mock_keystone.prefetch_users.assert_has_calls(
+            [mock.call(ksclient, {'u1', 'u2'}), mock.call(ksclient, {'u1'})]
+        )
+
+
+class AddressFilterTestCase(unittest.TestCase):
+    def test_exact_address(self):
+        ips = nova.AddressFilter('10.0.0.1')
+        self.assertIn('10.0.0.1', ips)
+        self.assertNotIn('10.0.0.10', ips)
+
+    def test_bracket_range(self):
+        ips = nova.AddressFilter('192.168.122.[124-127]')
+        self.assertIn('192.168.122.125', ips)
+        self.assertNotIn('192.168.122.128', ips)
+
+    def test_cidr(self):
+        ips = nova.AddressFilter('10.0.0.0/16,10.0.128.0/17,2001:db8::/32')
+        self.assertIn('10.0.255.1', ips)
+        self.assertNotIn('10.1.0.1', ips)
+        self.assertIn('2001:db8::5', ips)
+        self.assertNotIn('2001:db9::5', ips)
+        self.assertEqual(2, len(ips.starts))
+
+    def test_partial_address(self):
+        ips = nova.AddressFilter('192.168.')
+        self.assertIn('192.168.1.1', ips)
+        self.assertNotIn('10.0.0.1', ips)
+
+    def test_match_server(self):
+        server = FakeServer(
+            'a', addresses={'net': [{'addr': '10.0.0.10'}, {'addr': None}]}
+        )
+        self.assertTrue(
+            nova._match_ip_address(server, nova.AddressFilter('10.0.0.0/24'))
+        )
+        self.assertFalse(
+            nova._match_ip_address(server, nova.AddressFilter('10.0.0.1'))
+        )
+
+
+class PlanFiltersTestCase(unittest.TestCase):
+    def test_zones(self):
+        zones = nova.parse_nodes('az[1-2]')
+        opts, az_list, ip_list = nova._plan_filters(
+            {'all_tenants': True}, zones, zone_pushdown=True
+        )
+        self.assertEqual('^az1$|^az2$', opts['availability_zone'])
+        self.assertIsNone(az_list)
+        # only pushed down when asked
+        opts, az_list, ip_list = nova._plan_filters({}, zones)
+        self.assertNotIn('availability_zone', opts)
+        self.assertIs(zones, az_list)
+
+    def test_addresses_stay_client_side(self):
+        ips = nova.AddressFilter('10.0.0.1,10.1.0.0/16,2001:db8::1')
+        opts, az_list, ip_list = nova._plan_filters({}, None, ips)
+        self.assertNotIn('ip', opts)
+        self.assertNotIn('ip6', opts)
+        self.assertIs(ips, ip_list)
+
+    def test_floating_address_found(self):
+        # nova passes ip to neutron as a substring of the fixed addresses,
+        # so a floating IP lookup only works when filtered client side
+        servers = [
+            FakeServer(
+                'a',
+                addresses={
+                    'private': [
+                        {'addr': '10.0.0.5', 'OS-EXT-IPS:type': 'fixed'},
+                        {'addr': '203.0.113.9', 'OS-EXT-IPS:type': 'floating'},
+                    ]
+                },
+            ),
+            FakeServer(
+                'b',
+                addresses={
+                    'private': [
+                        {'addr': '10.0.0.50', 'OS-EXT-IPS:type': 'fixed'}
+                    ]
+                },
+            ),
+        ]
+
+        def list_servers(search_opts):
+            if search_opts.get('marker'):
+                return []
+            ip = search_opts.get('ip')
+            return [
+                server
+                for server in servers
+                if ip is None
+                or any(
+                    ip in a['addr'] and a['OS-EXT-IPS:type'] == 'fixed'
+                    for addrs in server.addresses.values()
+                    for a in addrs
+                )
+            ]
+
+        client = mock.Mock()
+        client.servers.list.side_effect = list_servers
+        for ip, expected in (
+            ('203.0.113.9', ['a']),
+            ('10.0.0.5', ['a']),
+            ('10.0.0.0/24', ['a', 'b']),
+        ):
+            result = nova.all_servers(client, ip=ip)
+            self.assertEqual(expected, [s.id for s in result])
+
+
+class InventoryTestCase(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, 'inv.db')
+        self.inventory = nova.Inventory(self.path)
+        self.client = mock.Mock()
+
+    def _server(self, server_id, **kwargs):
+        return FakeServer(server_id, user_id='u1', tenant_id='p1', **kwargs)
+
+    def _ids(self, opts=None, **kwargs):
+        servers = self.inventory.servers(self.client, opts or {}, **kwargs)
+        return [s.id for s in servers]
+
+    def test_full_then_delta(self):
+        self.client.servers.list.side_effect = [
+            [self._server('a', host='cc1'), self._server('b', host='cc2')],
+            [],
+        ]
+        self.inventory.refresh(self.client)
+        opts = self.client.servers.list.call_args.kwargs['search_opts']
+        self.assertNotIn('changes-since', opts)
+        self.assertEqual(['a', 'b'], self._ids())
+
+        # fresh enough, so no API call at all
+        self.inventory.refresh(self.client, max_age=60)
+        self.assertEqual(2, self.client.servers.list.call_count)
+
+        deleted = self._server('a', host='cc1', status='DELETED')
+        self.client.servers.list.side_effect = [
+            [deleted, self._server('c', host='cc1', zone='other')],
+            [],
+        ]
+        self.inventory.refresh(self.client)
+        opts = self.client.servers.list.call_args.kwargs['search_opts']
+        # the latest update nova reported, not the local time
+        self.assertEqual('2016-03-04T06:27:59Z', opts['changes-since'])
+        self.assertEqual(['c', 'b'], self._ids())
+        self.assertEqual(['c'], self._ids(host_list={'cc1'}))
+        self.assertEqual(['b'], self._ids(az_list={'melbourne-qh2'}))
+        self.assertEqual(['c', 'b'], self._ids({'tenant_id': 'p1'}))
+        self.assertEqual([], self._ids({'user_id': 'u2'}))
+        self.assertEqual(['c', 'b'], self._ids({'tenant_id': ['p2', 'p1']}))
+
+    def test_not_locked_while_listing(self):
+        def list_servers(search_opts):
+            if 'marker' not in search_opts:
+                return [self._server('a')]
+            # another process can still write while the pages come in
+            other = sqlite3.connect(self.path, timeout=0)
+            other.execute('BEGIN IMMEDIATE')
+            other.rollback()
+            other.close()
+            return []
+
+        self.client.servers.list.side_effect = list_servers
+        self.inventory.refresh(self.client)
+        self.assertEqual(['a'], self._ids())
+
+    @mock.patch('hivemind_contrib.nova.keystone')
+    def test_several_owners_refresh_once(self, mock_keystone):
+        mock_keystone.get_project.side_effect = lambda c, name, **kw: (
+            mock.Mock(id=name)
+        )
+        self.client.servers.list.side_effect = [
+            [
+                self._server('a'),
+                FakeServer('b', user_id='u1', tenant_id='p2'),
+                FakeServer('c', user_id='u1', tenant_id='p3'),
+            ],
+            [],
+        ]
+        servers = nova.iter_servers(
+            self.client,
+            project='p1,p2',
+            max_age=0,
+            inventory_path=self.path,
+        )
+        self.assertEqual(['a', 'b'], [s.id for s in servers])
+        # one listing for the inventory, none per owner
+        self.assertEqual(2, self.client.servers.list.call_count)
+
+
+class MatchScenarioTestCase(unittest.TestCase):
+    def test_order_and_parsed_once(self):
+        servers = [{'id': str(i)} for i in range(10)]
+        seen = []
+
+        def check(novaclient, server, changes_since):
+            seen.append(changes_since)
+            return int(server['id']) % 2 == 0
+
+        result = nova.match_scenario(
+            servers, check, mock.Mock(), '2016-03-04T06:27:59Z', workers=4
+        )
+
+        self.assertEqual(['0', '2', '4', '6', '8'], [s['id'] for s in result])
+        self.assertEqual(
+            {nova._normalize_time('2016-03-04T06:27:59Z')}, set(seen)
+        )
+
+    def test_timeout(self):
+        servers = [{'id': 'slow'}, {'id': 'fast'}]
+
+        def check(novaclient, server, changes_since):
+            if server['id'] == 'slow':
+                time.sleep(0.5)
+            return True
+
+        out, err = io.StringIO(), io.StringIO()
+        with mock.patch('sys.stdout', out), mock.patch('sys.stderr', err):
+            rows = nova.iter_scenario_matches(
+                servers, check, mock.Mock(), None, timeout=0.1
+            )
+            self.assertEqual([{'id': 'fast'}], list(rows))
+        # keep the csv/jsonl output on stdout clean
+        self.assertEqual('', out.getvalue())
+        self.assertIn('Timed out checking server slow', err.getvalue())
+
+    def test_hung_checks_dont_time_out_queued_ones(self):
+        servers = [{'id': str(i)} for i in range(8)]
+
+        def check(novaclient, server, changes_since):
+            if server['id'] in ('0', '1'):
+                time.sleep(0.6)
+            return True
+
+        result = nova.match_scenario(
+            servers, check, mock.Mock(), None, workers=2, timeout=0.1
+        )
+        self.assertEqual(
+            [str(i) for i in range(2, 8)], [s['id'] for s in result]
+        )
+
+    def test_timeout_client(self):
+        cloud = benchmark.FakeCloud(servers=3, projects=1)
+        with benchmark.FakeOpenStack(cloud) as fake:
+            novaclient = fake.nova('2.66')
+            timed = nova._timeout_client(novaclient, 5)
+            self.assertEqual(5, timed.client.session.timeout)
+            self.assertIsNone(novaclient.client.session.timeout)
+            self.assertEqual('2.66', timed.api_version.get_string())
+            self.assertEqual(3, len(timed.servers.list()))
+
+    def test_compute_failure(self):
+        novaclient = mock.Mock()
+        novaclient.instance_action.list.return_value = [
+            mock.Mock(
+                start_time='2016-03-05T00:00:00',
+                action='stop',
+                project_id=None,
+                user_id=None,
+            )
+        ]
+        since = nova._normalize_time('2016-03-04T06:27:59Z')
+        self.assertTrue(
+            nova._scenario_compute_failure(novaclient, {'id': 'a'}, since)
+        )
+
+
+class ServerInfoTestCase(unittest.TestCase):
+    def test_mapping_access(self):
+        info = nova.ServerInfo(id='a', name='vm', email='x@example.com')
+        self.assertEqual('a', info['id'])
+        self.assertEqual('vm', info.name)
+        self.assertIsNone(info['fullname'])
+        self.assertIn('project_name', info)
+        self.assertRaises(KeyError, lambda: info['nope'])
+        self.assertEqual(list(nova.ServerInfo.__slots__), info.keys())
+        self.assertEqual('x@example.com', info.to_dict()['email'])
+        self.assertFalse(hasattr(info, '__dict__'))
+
+    @mock.patch('hivemind_contrib.nova.keystone')
+    def test_extract(self, mock_keystone):
+        mock_keystone.get_project.return_value.name = 'proj'
+        mock_keystone.get_user.return_value = mock.Mock(
+            enabled=True, email='u@example.com', full_name='U'
+        )
+        server = FakeServer(
+            'a',
+            flavor={'id': 'f1'},
+            image={'id': 'i1'},
+            user_id='u1',
+            tenant_id='p1',
+            addresses={'net': [{'addr': '10.0.0.1'}]},
+        )
+
+        info = nova.extract_server_info(server, mock.Mock())
+
+        self.assertIsInstance(info, nova.ServerInfo)
+        self.assertEqual('i1', info['image'])
+        self.assertEqual('proj', info.project_name)
+        self.assertEqual(['10.0.0.1'], info.addresses)
+        self.assertEqual(('u1', 'p1'), (info.user, info.project))
+
+
+class WriteRowsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rows = [
+            nova.ServerInfo(id='a', host='cc1', addresses=['10.0.0.1']),
+            nova.ServerInfo(id='b', host='cc2', addresses=[]),
+        ]
+
+    def test_csv(self):
+        out = io.StringIO()
+        count = nova.write_rows(self.rows, 'csv', ['id', 'addresses'], out)
+        self.assertEqual(2, count)
+        self.assertEqual(
+            'id,addresses\r\na,10.0.0.1\r\nb,\r\n', out.getvalue()
+        )
+
+    def test_jsonl(self):
+        out = io.StringIO()
+        nova.write_rows(iter(self.rows), 'jsonl', ['id', 'host'], out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual({'id': 'a', 'host': 'cc1'}, json.loads(lines[0]))
+        self.assertEqual(2, len(lines))
+
+    @mock.patch('hivemind_contrib.nova.write_rows')
+    @mock.patch('hivemind_contrib.nova.iter_servers_info')
+    @mock.patch('hivemind_contrib.nova.iter_servers')
+    @mock.patch('hivemind_contrib.nova.keystone')
+    @mock.patch('hivemind_contrib.nova.client')
+    def test_list_instances_streams(
+        self, mock_client, mock_keystone, mock_servers, mock_info, mock_write
+    ):
+        mock_info.return_value = iter(self.rows)
+        result = nova.list_instances(format='jsonl', columns='id,email')
+        self.assertIsNone(result)
+        mock_write.assert_called_once_with(
+            mock_info.return_value, 'jsonl', ['id', 'email'], written=None
+        )
+
+    def test_list_instances_bad_column(self):
+        self.assertRaises(
+            SystemExit, nova.list_instances, format='csv', columns='id,nope'
+        )
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_list_instances_against_fake_cloud(self):
+        result = benchmark.run(servers=25, projects=5, page_size=10)
+
+        self.assertEqual(25, result['instances'])
+        # three pages and the empty one ending the listing
+        self.assertEqual(4, result['api_calls']['servers'])
+        self.assertLessEqual(result['api_calls'].get('projects', 0), 5)
+
+    def test_raw_matches_novaclient(self):
+        cloud = benchmark.FakeCloud(servers=25, projects=5)
+        with benchmark.FakeOpenStack(cloud, page_size=10) as fake:
+            rows = {}
+            for raw in (False, True):
+                servers = nova.iter_servers(fake.nova(), raw=raw)
+                rows[raw] = [
+                    info.to_dict()
+                    for info in nova.iter_servers_info(
+                        servers, fake.keystone()
+                    )
+                ]
+        self.assertEqual(25, len(rows[True]))
+        self.assertEqual(rows[False], rows[True])
+
+    def test_partitioned_scan(self):
+        result = benchmark.run(
+            servers=25, projects=5, page_size=10, partitions=3
+        )
+        self.assertEqual(25, result['instances'])
+
+    def test_embedded_flavor(self):
+        cloud = benchmark.FakeCloud(servers=3, projects=1)
+        with benchmark.FakeOpenStack(cloud) as fake:
+            servers = nova.iter_servers(
+                fake.nova(nova.CHANGES_BEFORE_VERSION), partitions=2
+            )
+            rows = list(nova.iter_servers_info(servers, fake.keystone()))
+        self.assertEqual(['m3.small'] * 3, [row.flavor for row in rows])
+
+
+class MarkerPagingTestCase(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.checkpoint = os.path.join(tmpdir.name, 'scan.json')
+        self.client = mock.Mock()
+
+    def _pages(self, *pages):
+        # search_opts is updated in place, so record the marker of each call
+        self.markers = []
+        self.limits = []
+        pages = iter(pages)
+
+        def list_servers(search_opts):
+            self.markers.append(search_opts.get('marker'))
+            self.limits.append(search_opts.get('limit'))
+            page = next(pages)
+            if isinstance(page, Exception):
+                raise page
+            return page
+
+        self.client.servers.list.side_effect = list_servers
+
+    def test_checkpoint_resume(self):
+        self._pages(
+            [FakeServer('a'), FakeServer('b')],
+            [FakeServer('c'), FakeServer('d')],
+            [],
+        )
+        with self.assertRaises(RuntimeError):
+            with nova.Checkpoint(self.checkpoint, interval=0) as checkpoint:
+                servers = nova.iter_servers(
+                    self.client, page_size=2, checkpoint=checkpoint
+                )
+                # a consumer batching ahead only writes out a and b
+                batch = list(itertools.islice(servers, 4))
+                for server in batch[:2]:
+                    checkpoint.written({'id': server.id})
+                raise RuntimeError('failed before writing c and d')
+        self.assertTrue(os.path.exists(self.checkpoint))
+
+        self._pages([FakeServer('c'), FakeServer('d')], [])
+        with nova.Checkpoint(self.checkpoint) as checkpoint:
+            servers = nova.iter_servers(self.client, checkpoint=checkpoint)
+            self.assertEqual(['c', 'd'], [s.id for s in servers])
+        self.assertEqual(['b', 'd'], self.markers)
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_nothing_written_keeps_no_marker(self):
+        self._pages([FakeServer('a'), FakeServer('b')], [])
+        with self.assertRaises(RuntimeError):
+            with nova.Checkpoint(self.checkpoint, interval=0) as checkpoint:
+                list(nova.iter_servers(self.client, checkpoint=checkpoint))
+                raise RuntimeError('failed before writing anything')
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    @mock.patch('hivemind_contrib.nova.error', side_effect=SystemExit)
+    def test_checkpoint_needs_streamed_output(self, mock_error):
+        with self.assertRaises(SystemExit):
+            nova.list_instances(checkpoint=self.checkpoint)
+
+    @mock.patch('hivemind_contrib.nova.client')
+    @mock.patch('hivemind_contrib.nova.keystone')
+    def test_list_instances_saves_written_rows(self, mock_keystone, client):
+        servers = [
+            FakeServer(
+                str(i), flavor={'id': 'f1'}, user_id='u1', tenant_id='p1'
+            )
+            for i in range(4)
+        ]
+        client.return_value.servers.list.side_effect = [servers, []]
+        mock_keystone.prefetch_projects.side_effect = RuntimeError
+        with mock.patch('sys.stdout', io.StringIO()) as out:
+            with self.assertRaises(RuntimeError):
+                nova.list_instances(format='jsonl', checkpoint=self.checkpoint)
+        # keystone failed before any row was written out
+        self.assertEqual('', out.getvalue())
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_limit_with_page_size(self):
+        servers = [
+            FakeServer(str(i), addresses={'n': [{'addr': f'10.0.0.{i}'}]})
+            for i in range(10)
+        ]
+        limits = []
+
+        def list_servers(search_opts):
+            limits.append(search_opts.get('limit'))
+            start = 0
+            if 'marker' in search_opts:
+                start = int(search_opts['marker']) + 1
+            return servers[start : start + search_opts.get('limit', 1000)]
+
+        self.client.servers.list.side_effect = list_servers
+        for page_size in (4, 500, 'auto', None):
+            result = nova.iter_servers(
+                self.client, limit=6, page_size=page_size
+            )
+            self.assertEqual(
+                [str(i) for i in range(6)], [s.id for s in result]
+            )
+        # a filtered listing asks for whole pages but still stops at limit
+        limits.clear()
+        result = nova.iter_servers(
+            self.client, limit=3, page_size=4, ip='10.0.0.0/24'
+        )
+        self.assertEqual(['0', '1', '2'], [s.id for s in result])
+        self.assertEqual([4], limits)
+
+    def test_checkpoint_for_other_query(self):
+        with open(self.checkpoint, 'w') as fh:
+            json.dump({'opts': {'status': 'ERROR'}, 'marker': 'a'}, fh)
+        pages = nova._iter_marker_pages(
+            self.client,
+            {'all_tenants': True},
+            checkpoint=nova.Checkpoint(self.checkpoint),
+        )
+        self.assertRaises(ValueError, next, pages)
+
+    @mock.patch('time.sleep')
+    def test_retry_server_errors(self, mock_sleep):
+        self.client.servers.list.side_effect = [
+            nova_exceptions.ClientException(503),
+            [FakeServer('a')],
+            [],
+        ]
+        servers = nova.iter_servers(self.client, page_size=10)
+        self.assertEqual(['a'], [s.id for s in servers])
+        mock_sleep.assert_called_once_with(1)
+        opts = self.client.servers.list.call_args.kwargs['search_opts']
+        self.assertEqual(10, opts['limit'])
+
+    def test_adaptive_page_size(self):
+        sizer = nova.AdaptivePageSize(limit=100, target=1.0)
+        sizer.update(100, 0.1)
+        self.assertEqual(200, sizer.limit)
+        sizer.update(200, 2.0)
+        self.assertEqual(100, sizer.limit)
+        # nova capped the page at its max_limit
+        sizer.update(80, 0.01)
+        self.assertEqual(80, sizer.limit)
+        sizer.update(80, 0.01)
+        self.assertEqual(80, sizer.limit)
+
+
+class AggregateIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, 'aggregates.json')
+        self.client = mock.Mock()
+        self.client.aggregates.list.return_value = [
+            self._aggregate('gpu', 'az1', ['cc2', 'cc3']),
+            self._aggregate('all', 'az1', ['cc1', 'cc2', 'cc3']),
+            self._aggregate('other', 'az2', ['db1']),
+        ]
+
+    def _aggregate(self, name, zone, hosts):
+        aggregate = mock.Mock(availability_zone=zone, hosts=hosts)
+        aggregate.name = name
+        return aggregate
+
+    def test_index_and_cache(self):
+        index = nova.AggregateIndex.load(self.client, 'az1', path=self.path)
+        self.assertEqual(['cc1', 'cc2', 'cc3'], index.all_hosts())
+        self.assertEqual({'all', 'gpu'}, index.aggregates['cc2'])
+        self.assertEqual(
+            [
+                {'aggregate': 'all', 'cc1': True, 'db1': False},
+                {'aggregate': 'gpu', 'cc1': False, 'db1': False},
+            ],
+            list(index.matrix(['cc1', 'db1'])),
+        )
+
+        cached = nova.AggregateIndex.load(self.client, 'az1', path=self.path)
+        self.assertEqual(index.hosts, cached.hosts)
+        self.assertEqual(1, self.client.aggregates.list.call_count)
+
+        nova.AggregateIndex.load(self.client, 'az1', 0, path=self.path)
+        nova.AggregateIndex.load(self.client, 'az2', path=self.path)
+        self.assertEqual(3, self.client.aggregates.list.call_count)
+
+    @mock.patch('hivemind_contrib.nova.client')
+    @mock.patch('hivemind_contrib.nova.AggregateIndex.load')
+    def test_list_host_aggregates_csv(self, mock_load, mock_client):
+        mock_load.return_value = nova.AggregateIndex(
+            {'gpu': ['cc2', 'cc3'], 'all': ['cc1', 'cc2', 'cc3']}
+        )
+        out = io.StringIO()
+        with mock.patch('sys.stdout', out):
+            nova.list_host_aggregates('az1', 'cc[1-2]', format='csv')
+        self.assertEqual(
+            'aggregate,cc1,cc2\r\nall,X,X\r\ngpu,,X\r\n', out.getvalue()
+        )
+
+
+class BootTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = mock.Mock()
+        nova.flavor_cache.clear()
+        self.addCleanup(nova.flavor_cache.clear)
+
+    def _address(self, addr):
+        return {'public': [{'addr': addr}]}
+
+    def test_flavor_index_listed_once(self):
+        flavor = mock.Mock(id='f1')
+        flavor.name = 'm1.small'
+        self.client.flavors.list.return_value = [flavor]
+        self.assertEqual('f1', nova.get_flavor_id(self.client, 'm1.small'))
+        self.assertEqual('f1', nova.get_flavor_id(self.client, 'f1'))
+        self.assertRaisesRegex(
+            Exception,
+            "Can't find flavor nope",
+            nova.get_flavor_id,
+            self.client,
+            'nope',
+        )
+        self.assertEqual(2, self.client.flavors.list.call_count)
+
+    @mock.patch('time.sleep')
+    def test_wait_for_backs_off(self, mock_sleep):
+        results = iter([None, None, None, 'done'])
+        self.assertEqual('done', nova.wait_for(lambda: next(results), 'x'))
+        self.assertEqual(
+            [mock.call(1), mock.call(2), mock.call(4)],
+            mock_sleep.call_args_list,
+        )
+
+    @mock.patch('time.sleep')
+    def test_wait_for_addresses(self, mock_sleep):
+        seen = []
+
+        def list_servers(search_opts):
+            seen.append(dict(search_opts))
+            return rounds.pop(0)
+
+        rounds = [
+            [
+                FakeServer('a', updated='2016-03-04T06:00:00Z'),
+                FakeServer('b', updated='2016-03-04T06:00:01Z'),
+            ],
+            [
+                FakeServer(
+                    'a',
+                    addresses=self._address('10.0.0.1'),
+                    updated='2016-03-04T06:00:05Z',
+                ),
+            ],
+            [
+                FakeServer(
+                    'b',
+                    addresses=self._address('10.0.0.2'),
+                    updated='2016-03-04T06:00:07Z',
+                ),
+            ],
+        ]
+        self.client.servers.list.side_effect = list_servers
+        addresses = nova.wait_for_addresses(self.client, 'r-1', 2)
+        self.assertEqual(
+            {
+                'a': ('server-a', '10.0.0.1'),
+                'b': ('server-b', '10.0.0.2'),
+            },
+            addresses,
+        )
+        self.assertEqual({'reservation_id': 'r-1'}, seen[0])
+        self.assertEqual('2016-03-04T06:00:01Z', seen[1]['changes-since'])
+        self.assertEqual('2016-03-04T06:00:05Z', seen[2]['changes-since'])
+
+    def test_wait_for_addresses_error(self):
+        self.client.servers.list.return_value = [
+            FakeServer('a', status='ERROR')
+        ]
+        self.assertRaisesRegex(
+            Exception,
+            'server-a failed to boot',
+            nova.wait_for_addresses,
+            self.client,
+            'r-1',
+            1,
+        )
+
+    @mock.patch('hivemind_contrib.nova.wait_for_addresses')
+    @mock.patch('hivemind_contrib.nova.client')
+    def test_boot_count(self, mock_client, mock_wait):
+        nova.flavor_cache['m1.small'] = 'f1'
+        # check the keyword arguments against novaclient's own signature
+        mock_client.return_value.servers = mock.create_autospec(
+            nova_servers.ServerManager, instance=True
+        )
+        mock_client.return_value.servers.create.return_value = 'r-1'
+        mock_wait.return_value = {'b': ('test-2', '10.0.0.2')}
+        with mock.patch('sys.stdout', io.StringIO()) as out:
+            nova.boot('test', count='2')
+        kwargs = mock_client.return_value.servers.create.call_args.kwargs
+        self.assertEqual((2, 2), (kwargs['min_count'], kwargs['max_count']))
+        self.assertEqual('f1', kwargs['flavor'])
+        self.assertTrue(kwargs['reservation_id'])
+        mock_wait.assert_called_once_with(
+            mock_client.return_value, 'r-1', 2, nova.BOOT_TIMEOUT
+        )
+        self.assertEqual('b\n10.0.0.2\n', out.getvalue())
+
+
+class FileContentsTestCase(unittest.TestCase):
+    @mock.patch('hivemind_contrib.swift.get_object_cached')
+    def test_order_kept(self, mock_get):
+        mock_get.return_value = b'#cloud-config\n'
+        with tempfile.NamedTemporaryFile('w', suffix='.sh') as f:
+            f.write('#!/bin/sh\n')
+            f.flush()
+            contents = list(
+                nova.file_contents(['swift://userdata/base.yaml', f.name])
+            )
+        self.assertEqual(['#cloud-config\n', '#!/bin/sh\n'], contents)
+        mock_get.assert_called_once_with('userdata', 'base.yaml')
+
+    def test_bad_scheme(self):
+        contents = nova.file_contents(['http://example.com/x'])
+        self.assertRaises(ValueError, list, contents)
+
+
+class ServicesTestCase(unittest.TestCase):
+    def _service(self, host, binary):
+        return mock.Mock(host=host, binary=binary)
+
+    @mock.patch('hivemind_contrib.nova.client')
+    def test_disable_many_hosts(self, mock_client):
+        services = mock_client.return_value.services
+        services.list.return_value = [
+            self._service('cc01', 'nova-compute'),
+            self._service('cc02', 'nova-compute'),
+            self._service('cc03', 'nova-compute'),
+            self._service('ctl1', 'nova-scheduler'),
+        ]
+        services.disable_log_reason.side_effect = [
+            None,
+            nova_exceptions.NotFound(404),
+        ]
+        with mock.patch('sys.stdout', io.StringIO()):
+            outcomes = nova._set_services(
+                'cc[01-02]', False, None, 'drain', workers=1
+            )
+        services.list.assert_called_once_with(binary=None)
+        self.assertEqual(
+            [
+                ('cc01', 'nova-compute', 'disabled'),
+                ('cc02', 'nova-compute', 'failed: Not found (HTTP 404)'),
+            ],
+            sorted(outcomes),
+        )
+
+    @mock.patch('hivemind_contrib.nova.client')
+    def test_enable(self, mock_client):
+        services = mock_client.return_value.services
+        services.list.return_value = [self._service('cc01', 'nova-compute')]
+        with mock.patch('sys.stdout', io.StringIO()):
+            nova.enable_services('cc01', binary='nova-compute')
+        services.list.assert_called_once_with(binary='nova-compute')
+        services.enable.assert_called_once_with('cc01', 'nova-compute')
+
+    @mock.patch('hivemind_contrib.nova.client')
+    def test_no_services(self, mock_client):
+        mock_client.return_value.services.list.return_value = []
+        self.assertRaises(SystemExit, nova.disable_services, 'cc01')
+
+
+class TroveSearchTestCase(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('hivemind_contrib.nova.keystone')
+        mock_keystone = patcher.start()
+        self.addCleanup(patcher.stop)
+        mock_keystone.get_project.side_effect = lambda c, name, **kw: (
+            mock.Mock(id=f'{name}-id')
+        )
+        self.trove_opts = []
+        trove_pages = [
+            [
+                FakeServer('t1', metadata={'project_id': 'p1-id'}),
+                FakeServer('t2', metadata={'project_id': 'other'}),
+            ],
+            [FakeServer('t3', metadata={'project_id': 'p1-id'})],
+            [],
+        ]
+        main_pages = [[FakeServer('a')], []]
+
+        def list_servers(search_opts):
+            if search_opts['tenant_id'] == 'trove-id':
+                self.trove_opts.append(dict(search_opts))
+                return trove_pages.pop(0)
+            return main_pages.pop(0)
+
+        self.client = mock.Mock()
+        self.client.servers.list.side_effect = list_servers
+
+    def test_paged_and_matched_on_metadata(self):
+        servers = list(nova.iter_servers(self.client, project='p1'))
+        self.assertEqual(['a', 't1', 't3'], sorted(s.id for s in servers))
+        self.assertEqual(3, len(self.trove_opts))
+        # nova has no metadata filter, so none is sent
+        self.assertNotIn('metadata', self.trove_opts[0])
+        self.assertEqual('t3', self.trove_opts[2]['marker'])
+
+    def test_several_owners_search_once(self):
+        owned = {'p1-id': [FakeServer('a')], 'p2-id': [FakeServer('b')]}
+        trove = [
+            FakeServer('t1', metadata={'project_id': 'p1-id'}),
+            FakeServer('t2', metadata={'project_id': 'p2-id'}),
+            FakeServer('t3', metadata={'project_id': 'other'}),
+        ]
+
+        def list_servers(search_opts):
+            if 'marker' in search_opts:
+                return []
+            if search_opts['tenant_id'] == 'trove-id':
+                self.trove_opts.append(dict(search_opts))
+                return trove
+            return owned[search_opts['tenant_id']]
+
+        self.client.servers.list.side_effect = list_servers
+        servers = list(nova.iter_servers(self.client, project='p1,p2'))
+        self.assertEqual(['a', 'b', 't1', 't2'], sorted(s.id for s in servers))
+        self.assertEqual(1, len(self.trove_opts))
+
+    def test_merge_pending(self):
+        done = mock.Mock(done=lambda: True, result=lambda: ['t'])
+        pages = list(nova._merge_pending(iter([['a'], ['b']]), done))
+        self.assertEqual([['t'], ['a'], ['b']], pages)
+        running = mock.Mock(done=lambda: False, result=lambda: ['t'])
+        pages = list(nova._merge_pending(iter([['a'], ['b']]), running))
+        self.assertEqual([['a'], ['b'], ['t']], pages)
+
+
+class RawServerTestCase(unittest.TestCase):
+    def test_query_and_fields(self):
+        client = mock.Mock()
+        client.client.get.return_value = (
+            mock.Mock(),
+            {
+                'servers': [
+                    {
+                        'id': 'a',
+                        'name': 'vm',
+                        'OS-EXT-SRV-ATTR:host': 'cc1',
+                        'OS-EXT-AZ:availability_zone': 'az1',
+                        'links': [],
+                    }
+                ]
+            },
+        )
+        raw = nova.RawClient(client)
+        [server] = raw.servers.list({'all_tenants': True, 'status': None})
+        client.client.get.assert_called_once_with(
+            '/servers/detail?all_tenants=True'
+        )
+        self.assertEqual('cc1', getattr(server, 'OS-EXT-SRV-ATTR:host'))
+        self.assertEqual('az1', server.zone)
+        self.assertNotIn('links', server.to_dict())
+        self.assertEqual(
+            'az1', server.to_dict()['OS-EXT-AZ:availability_zone']
+        )
+        self.assertRaises(AttributeError, getattr, server, 'links')
+        # everything else is still the wrapped client
+        self.assertIs(client.flavors, raw.flavors)
+
+
+class WindowPagesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = mock.Mock(api_version=api_versions.APIVersion('2.66'))
+
+    def test_time_windows(self):
+        start = nova._normalize_time('2020-01-01T00:00:00Z')
+        end = nova._normalize_time('2020-01-04T00:00:00Z')
+        self.assertEqual(
+            [
+                {'changes-before': '2020-01-02T00:00:00Z'},
+                {
+                    'changes-since': '2020-01-02T00:00:00Z',
+                    'changes-before': '2020-01-03T00:00:00Z',
+                },
+                {
+                    'changes-since': '2020-01-03T00:00:00Z',
+                    'changes-before': '2020-01-04T00:00:00Z',
+                },
+            ],
+            nova._time_windows(start, end, 3),
+        )
+
+    def test_dedup_and_deleted(self):
+        def list_servers(search_opts):
+            if 'marker' in search_opts:
+                return []
+            if 'changes-before' in search_opts:
+                return [FakeServer('a'), FakeServer('b', status='DELETED')]
+            # 'a' was updated again while the scan ran
+            return [FakeServer('a'), FakeServer('c')]
+
+        self.client.servers.list.side_effect = list_servers
+        servers = nova.iter_servers(self.client, partitions=2)
+        self.assertEqual(['a', 'c'], [s.id for s in servers])
+
+    def test_server_moved_during_scan(self):
+        now = datetime.datetime.now(dateutil.tz.tzutc())
+        updated = {
+            'a': '2012-01-01T00:00:00Z',
+            'moved': '2012-01-02T00:00:00Z',
+            'b': (now - datetime.timedelta(days=1)).strftime(
+                '%Y-%m-%dT%H:%M:%SZ'
+            ),
+        }
+        later_listed = threading.Event()
+
+        def list_servers(search_opts):
+            if 'marker' in search_opts:
+                return []
+            first = 'changes-since' not in search_opts
+            if first:
+                # 'moved' is updated after the later window was listed
+                later_listed.wait(5)
+                updated['moved'] = (
+                    now + datetime.timedelta(minutes=1)
+                ).strftime('%Y-%m-%dT%H:%M:%SZ')
+            servers = [
+                FakeServer(server_id, updated=time)
+                for server_id, time in updated.items()
+                if search_opts.get('changes-since', '') <= time
+                and time <= search_opts.get('changes-before', '9999')
+            ]
+            if not first:
+                later_listed.set()
+            return servers
+
+        self.client.servers.list.side_effect = list_servers
+        servers = nova.iter_servers(self.client, partitions=2, workers=2)
+        self.assertEqual(['a', 'b', 'moved'], sorted(s.id for s in servers))
+
+    def test_needs_changes_before(self):
+        self.client.api_version = api_versions.APIVersion('2.1')
+        servers = nova.iter_servers(self.client, partitions=2)
+        self.assertRaises(ValueError, list, servers)
+
+
+class CapacityReportTestCase(unittest.TestCase):
+    def _hypervisor(self, host, vcpus_used, memory_mb_used, status='enabled'):
+        return mock.Mock(
+            service={'host': host},
+            state='up',
+            status=status,
+            vcpus=16,
+            vcpus_used=vcpus_used,
+            memory_mb=65536,
+            memory_mb_used=memory_mb_used,
+            local_gb=1000,
+            local_gb_used=100,
+        )
+
+    def _flavor(self, name, vcpus, ram, disk):
+        flavor = mock.Mock(vcpus=vcpus, ram=ram, disk=disk)
+        flavor.name = name
+        return flavor
+
+    def setUp(self):
+        self.hypervisors = [
+            self._hypervisor('cc1', 8, 16384),
+            self._hypervisor('cc2', 14, 8192),
+            self._hypervisor('cc3', 0, 0, status='disabled'),
+        ]
+        self.index = nova.AggregateIndex(
+            {'gpu': ['cc1'], 'all': ['cc1', 'cc2']}
+        )
+        self.flavors = [
+            self._flavor('m3.small', 2, 4096, 30),
+            self._flavor('m3.large', 8, 32768, 0),
+        ]
+
+    def test_per_host(self):
+        columns, rows = nova.capacity_rows(
+            self.hypervisors, self.index, self.flavors, 'host', 1.0, 1.0
+        )
+        self.assertEqual(['host', 'hosts', 'vcpus'], columns[:3])
+        self.assertEqual(['m3.small', 'm3.large'], columns[-2:])
+        cc1, cc2, cc3 = rows
+        self.assertEqual(50.0, cc1['vcpu_util'])
+        self.assertEqual(25.0, cc1['ram_util'])
+        self.assertEqual((4, 1), (cc1['m3.small'], cc1['m3.large']))
+        # cpu bound on cc2, and nothing fits on a disabled host
+        self.assertEqual((1, 0), (cc2['m3.small'], cc2['m3.large']))
+        self.assertEqual((0, 0), (cc3['m3.small'], cc3['m3.large']))
+
+    def test_per_aggregate_with_ratio(self):
+        columns, rows = nova.capacity_rows(
+            self.hypervisors, self.index, self.flavors, 'aggregate', 2.0, 1.0
+        )
+        self.assertEqual(
+            ['(none)', 'all', 'gpu'], [row['aggregate'] for row in rows]
+        )
+        everything = rows[1]
+        self.assertEqual(2, everything['hosts'])
+        self.assertEqual(32, everything['vcpus'])
+        self.assertEqual(34.4, everything['vcpu_util'])
+        # cc1 has 24 vCPUs free and cc2 has 18 at a 2.0 ratio
+        self.assertEqual(12 + 9, everything['m3.small'])
+
+    @mock.patch('hivemind_contrib.nova.client')
+    def test_task_csv(self, mock_client):
+        nova_client = mock_client.return_value
+        nova_client.hypervisors.list.return_value = self.hypervisors
+        nova_client.aggregates.list.return_value = []
+        nova_client.flavors.list.return_value = self.flavors
+        out = io.StringIO()
+        with mock.patch('sys.stdout', out):
+            nova.capacity_report(
+                nodes='cc[1-2]', flavors='m3.large', format='csv'
+            )
+        lines = out.getvalue().splitlines()
+        self.assertEqual(3, len(lines))
+        self.assertTrue(lines[0].endswith(',disk_util,m3.large'))
+        self.assertTrue(lines[1].startswith('cc1,1,16,8,'))
+
+    def test_task_unknown_flavor(self):
+        with mock.patch('hivemind_contrib.nova.client'):
+            self.assertRaises(SystemExit, nova.capacity_report, flavors='nope')
+
+
+class WatchInstancesTestCase(unittest.TestCase):
+    def _server(self, server_id, updated, **kwargs):
+        return FakeServer(server_id, updated=updated, **kwargs)
+
+    @mock.patch('time.sleep')
+    def test_only_changes_reported(self, mock_sleep):
+        polls = [
+            [
+                self._server('a', '2016-03-04T06:00:00Z', status='BUILD'),
+                self._server('b', '2016-03-04T06:00:01Z', host='cc9'),
+            ],
+            [],
+            [
+                self._server('a', '2016-03-04T06:00:05Z', status='BUILD'),
+            ],
+            [],
+            [
+                self._server('a', '2016-03-04T06:00:05Z', host='cc2'),
+            ],
+            [],
+        ]
+        seen = []
+
+        def list_servers(search_opts):
+            seen.append(search_opts.get('changes-since'))
+            return polls.pop(0)
+
+        client = mock.Mock()
+        client.servers.list.side_effect = list_servers
+        changes = nova.iter_instance_changes(
+            client,
+            {'changes-since': '2016-03-04T05:00:00Z'},
+            host_list=nova.parse_nodes('cc[1-2]'),
+            polls=3,
+        )
+        self.assertEqual(
+            [('a', 'BUILD', 'cc1'), ('a', 'ACTIVE', 'cc2')],
+            [(c['id'], c['status'], c['host']) for c in changes],
+        )
+        # each poll is a page and the empty one after it
+        self.assertEqual(
+            [
+                '2016-03-04T05:00:00Z',
+                '2016-03-04T06:00:01Z',
+                '2016-03-04T06:00:05Z',
+            ],
+            seen[::2],
+        )
+        self.assertEqual(2, mock_sleep.call_count)
+
+
+class DbServersTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cloud = benchmark.FakeCloud(servers=30, projects=5, hosts=6)
+        # a trove instance owned by project 1 through its metadata
+        trove = dict(self.cloud.servers[-1], tenant_id='trove')
+        trove['metadata'] = {
+            'project_id': self.cloud.projects[1]['id'],
+            'user_id': self.cloud.users[2]['id'],
+        }
+        self.cloud.servers[-1] = trove
+        self.db = sqlalchemy.create_engine('sqlite://').connect()
+        nova.metadata.create_all(self.db)
+        for i, server in enumerate(self.cloud.servers):
+            self._insert(i, server)
+        # a deleted instance the API would not list
+        self._insert(
+            99,
+            dict(self.cloud.servers[0], id='gone', name='gone'),
+            deleted=99,
+        )
+
+    def _insert(self, i, server, deleted=0):
+        updated = nova._normalize_time(server['updated']).replace(tzinfo=None)
+        network_info = [
+            {
+                'network': {
+                    'label': label,
+                    'subnets': [
+                        {
+                            'ips': [
+                                {'address': a['addr'], 'version': 4}
+                                for a in addresses
+                            ]
+                        }
+                    ],
+                }
+            }
+            for label, addresses in server['addresses'].items()
+        ]
+        flavor = {
+            'cur': {'nova_object.data': {'flavorid': server['flavor']['id']}}
+        }
+        self.db.execute(
+            nova.instances_table.insert().values(
+                # newest first, the same order as the fake API
+                created_at=datetime.datetime(2016, 1, 1)
+                - datetime.timedelta(minutes=i),
+                updated_at=updated,
+                deleted=deleted,
+                uuid=server['id'],
+                display_name=server['name'],
+                image_ref=server['image']['id'],
+                vm_state='active',
+                host=server['OS-EXT-SRV-ATTR:host'],
+                availability_zone=server['OS-EXT-AZ:availability_zone'],
+                project_id=server['tenant_id'],
+                user_id=server['user_id'],
+            )
+        )
+        self.db.execute(
+            nova.instance_extra_table.insert().values(
+                instance_uuid=server['id'],
+                deleted=0,
+                flavor=json.dumps(flavor),
+            )
+        )
+        self.db.execute(
+            nova.instance_info_caches_table.insert().values(
+                instance_uuid=server['id'],
+                deleted=0,
+                network_info=json.dumps(network_info),
+            )
+        )
+        for key, value in server['metadata'].items():
+            self.db.execute(
+                nova.instance_metadata_table.insert().values(
+                    instance_uuid=server['id'], deleted=0, key=key, value=value
+                )
+            )
+
+    def _rows(self, servers, ksclient):
+        rows = [
+            info.to_dict()
+            for info in nova.iter_servers_info(servers, ksclient)
+        ]
+        return sorted(rows, key=lambda row: row['id'])
+
+    def test_same_as_api(self):
+        project = self.cloud.projects[1]['id']
+        searches = [
+            {},
+            {'status': 'ACTIVE'},
+            {'host': 'cc[0001-0002]'},
+            {'zone': 'az2', 'ip': '10.0.0.[0-20]'},
+            {'project': project},
+            {'project': f"{project},{self.cloud.projects[2]['id']}"},
+        ]
+        get_project = nova.keystone.get_project
+        with (
+            benchmark.FakeOpenStack(self.cloud, page_size=7) as fake,
+            mock.patch.object(nova.keystone, 'client', fake.keystone),
+            mock.patch.object(nova.keystone, 'get_project') as mock_project,
+        ):
+            # the fake cloud's trove project is just called trove
+            mock_project.side_effect = lambda ks, name, **kw: (
+                mock.Mock(id='trove')
+                if name == 'trove'
+                else get_project(ks, name, **kw)
+            )
+            ksclient = fake.keystone()
+            for search in searches:
+                api = self._rows(
+                    nova.iter_servers(fake.nova(), **search), ksclient
+                )
+                db = self._rows(
+                    nova.iter_servers(None, db=self.db, **search), ksclient
+                )
+                self.assertTrue(api, search)
+                self.assertEqual(api, db, search)
+            # the trove instance is found through its owner metadata
+            self.assertIn(self.cloud.servers[-1]['id'], [r['id'] for r in db])
+
+    def test_limit_and_order(self):
+        servers = list(nova.iter_servers(None, db=self.db, limit=3))
+        self.assertEqual(
+            [s['id'] for s in self.cloud.servers[:3]], [s.id for s in servers]
+        )
+
+
+class NeutronLookupTestCase(unittest.TestCase):
+    @mock.patch('hivemind_contrib.neutron.get_neutron_client')
+    @mock.patch('hivemind_contrib.neutron.find_device_ids')
+    def test_servers_fetched_by_id(self, mock_find, mock_neutron):
+        address = {'public': [{'addr': '10.0.0.1'}]}
+        servers = {
+            'a': FakeServer('a', addresses=address, tenant_id='p1'),
+            'b': FakeServer('b', addresses=address, tenant_id='p2'),
+            'c': FakeServer(
+                'c', addresses=address, tenant_id='p1', status='SHUTOFF'
+            ),
+        }
+        for server in servers.values():
+            server.user_id = 'u1'
+
+        def get(server_id):
+            if server_id not in servers:
+                raise nova_exceptions.NotFound(404)
+            return servers[server_id]
+
+        client = mock.Mock()
+        client.servers.get.side_effect = get
+        mock_find.return_value = {'a', 'b', 'c', 'deleted'}
+        with mock.patch.object(nova.keystone, 'get_project') as get_project:
+            get_project.return_value = mock.Mock(id='p1')
+            with mock.patch.object(nova.keystone, 'client'):
+                result = nova.iter_servers(
+                    client,
+                    ip='10.0.0.1',
+                    status='ACTIVE',
+                    project='p1',
+                    use_neutron=True,
+                )
+                self.assertEqual(['a'], [s.id for s in result])
+        client.servers.list.assert_not_called()
+
+    @mock.patch('hivemind_contrib.neutron.get_neutron_client')
+    def test_partial_addresses_scan(self, mock_neutron):
+        ip_list = nova.AddressFilter('10.0.0.1,192.168')
+        self.assertIsNone(ip_list.device_ids(mock_neutron.return_value))
+
+
+class OwnersTestCase(unittest.TestCase):
+    def test_owner_list(self):
+        self.assertEqual(['a', 'b'], nova._owner_list('a, b,,a'))
+        self.assertEqual([], nova._owner_list(None))
+        with tempfile.NamedTemporaryFile('w') as f:
+            f.write('# projects to notify\np1\n\np2\np1\n')
+            f.flush()
+            self.assertEqual(['p1', 'p2'], nova._owner_list(f.name))
+
+    @mock.patch('hivemind_contrib.nova.keystone')
+    def test_projects_listed_concurrently(self, mock_keystone):
+        # the cache already knows the trove project
+        mock_keystone.project_cache = {'trove': mock.Mock(id='trove-id')}
+
+        def get_project(ksclient, name, use_cache=False):
+            project = mock.Mock(id=f'{name}-id')
+            mock_keystone.project_cache[project.id] = project
+            mock_keystone.project_cache[name] = project
+            return project
+
+        mock_keystone.get_project.side_effect = get_project
+        shared = FakeServer('shared')
+
+        def list_servers(search_opts):
+            if 'marker' in search_opts:
+                return []
+            tenant = search_opts['tenant_id']
+            if tenant == 'trove-id':
+                return []
+            return [FakeServer(tenant), shared]
+
+        client = mock.Mock()
+        client.servers.list.side_effect = list_servers
+        servers = nova.iter_servers(client, project='p1,p2,p3', workers=3)
+        self.assertEqual(
+            ['p1-id', 'shared', 'p2-id', 'p3-id'], [s.id for s in servers]
+        )
+        # each name is looked up once with one client
+        names = [c.args[1] for c in mock_keystone.get_project.call_args_list]
+        self.assertEqual(['p1', 'p2', 'p3'], sorted(names))
+        mock_keystone.client.assert_called_once_with()
+
+
+class CloudsTestCase(unittest.TestCase):
+    def test_cloud_clients_uses_profile_settings(self):
+        with (
+            mock.patch.object(nova, '_cloud_settings') as settings,
+            mock.patch.object(nova.keystone, 'get_session') as get_session,
+            mock.patch.object(nova.keystone, 'client') as ks_client,
+            mock.patch.object(nova.nova_client, 'Client') as nova_client,
+        ):
+            settings.return_value = {
+                'auth_url': 'https://keystone.example.com',
+                'username': None,
+                'password': None,
+                'tenant_name': None,
+                'region': 'Melbourne',
+            }
+            novaclient, ksclient = nova.cloud_clients('melbourne')
+        # the unset settings fall back to the default profile
+        get_session.assert_called_once_with(
+            auth_url='https://keystone.example.com'
+        )
+        nova_client.assert_called_once_with(
+            '2.1', session=get_session.return_value, region_name='Melbourne'
+        )
+        ks_client.assert_called_once_with(session=get_session.return_value)
+        self.assertIs(nova_client.return_value, novaclient)
+        self.assertIs(ks_client.return_value, ksclient)
+
+    def test_list_instances_across_clouds(self):
+        clouds = [
+            benchmark.FakeCloud(servers=count, projects=2) for count in (3, 5)
+        ]
+        with (
+            benchmark.FakeOpenStack(clouds[0]) as one,
+            benchmark.FakeOpenStack(clouds[1]) as two,
+        ):
+            fakes = {'one': one, 'two': two}
+            out = io.StringIO()
+            with (
+                mock.patch.object(
+                    nova,
+                    'cloud_clients',
+                    lambda profile, version: (
+                        fakes[profile].nova(version),
+                        fakes[profile].keystone(),
+                    ),
+                ),
+                mock.patch('sys.stdout', out),
+            ):
+                nova.list_instances(
+                    status='ALL',
+                    format='jsonl',
+                    columns='id,name',
+                    clouds='one, two',
+                )
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(
+            ['one'] * 3 + ['two'] * 5, [row['region'] for row in rows]
+        )
+        self.assertEqual(['region', 'id', 'name'], list(rows[0]))
+        self.assertEqual(
+            [s['id'] for cloud in clouds for s in cloud.servers],
+            [row['id'] for row in rows],
+        )
+
+    @mock.patch('hivemind_contrib.nova.cloud_clients')
+    @mock.patch('hivemind_contrib.nova.iter_servers')
+    def test_clouds_keep_their_own_state(self, mock_servers, mock_clients):
+        mock_clients.return_value = (mock.Mock(), mock.Mock())
+        mock_servers.return_value = []
+        with mock.patch('sys.stdout', io.StringIO()):
+            nova.list_instances(
+                format='jsonl',
+                max_age=60,
+                checkpoint='/tmp/scan.json',
+                clouds='one,two',
+            )
+        calls = sorted(
+            mock_servers.call_args_list,
+            key=lambda call: call.kwargs['checkpoint'].path,
+        )
+        self.assertEqual(
+            ['/tmp/scan.one.json', '/tmp/scan.two.json'],
+            [call.kwargs['checkpoint'].path for call in calls],
+        )
+        paths = {call.kwargs['inventory_path'] for call in calls}
+        self.assertEqual(2, len(paths))
+        self.assertNotIn(nova.INVENTORY_PATH, paths)
+
+    @mock.patch('hivemind_contrib.nova.error', side_effect=SystemExit)
+    def test_clouds_reject_default_cloud_options(self, mock_error):
+        for option in ('db', 'use_neutron', 'project', 'user'):
+            with self.assertRaises(SystemExit):
+                nova.list_instances(clouds='one,two', **{option: 'x'})
+
+    @mock.patch('hivemind_contrib.nova.warn')
+    @mock.patch('hivemind_contrib.nova.cloud_clients')
+    def test_fan_out_warns_of_auth_url(self, mock_clients, mock_warn):
+        mock_clients.return_value = (mock.Mock(), mock.Mock())
+        with mock.patch.dict(os.environ, {'OS_AUTH_URL': 'https://ks'}):
+            nova.fan_out('one', lambda *args: None)
+            mock_warn.assert_not_called()
+            nova.fan_out('one,two', lambda *args: None)
+        mock_warn.assert_called_once()
+
+    @mock.patch('hivemind_contrib.nova.cloud_clients')
+    @mock.patch('hivemind_contrib.nova.AggregateIndex.load')
+    def test_list_host_aggregates_across_clouds(self, mock_load, mock_clients):
+        indexes = {
+            'one': nova.AggregateIndex({'gpu': ['cc1']}),
+            'two': nova.AggregateIndex({'gpu': ['cc2'], 'all': ['cc2']}),
+        }
+        clients = {'one': mock.Mock(), 'two': mock.Mock()}
+        mock_clients.side_effect = lambda profile, version: (
+            clients[profile],
+            mock.Mock(),
+        )
+        mock_load.side_effect = lambda client, zone, max_age, path: next(
+            indexes[p] for p in clients if clients[p] is client
+        )
+        out = io.StringIO()
+        with mock.patch('sys.stdout', out):
+            nova.list_host_aggregates('az1', format='csv', clouds='one,two')
+        self.assertEqual(
+            'region,aggregate,cc1,cc2\r\n'
+            'one,gpu,X,\r\n'
+            'two,all,,X\r\n'
+            'two,gpu,,X\r\n',
+            out.getvalue(),
+        )
+        # each cloud keeps its own aggregate cache
+        paths = {call.kwargs['path'] for call in mock_load.call_args_list}
+        self.assertEqual(2, len(paths))
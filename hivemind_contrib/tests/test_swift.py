@@ -1,3 +1,7 @@
+import hashlib
+import threading
+from unittest import mock
+
 from hivemind_contrib import swift
 
 
@@ -8,3 +12,41 @@ def test_size_to_bytes():
     assert swift.size_to_bytes("1234TB") == 1454742194200864
     assert swift.size_to_bytes("123PB") == 151092778008061536
     assert swift.size_to_bytes("12ZB") == 16004985270355602494976
+
+
+def test_get_object_cached(tmp_path, monkeypatch):
+    contents = b'#cloud-config\n'
+    etag = hashlib.md5(contents).hexdigest()
+    conn = mock.Mock()
+    conn.head_object.return_value = {'etag': etag}
+    conn.get_object.return_value = ({'etag': etag}, contents)
+    monkeypatch.setattr(swift, 'connection', lambda: conn)
+
+    for _ in range(2):
+        assert swift.get_object_cached('c', 'o', tmp_path) == contents
+    assert conn.head_object.call_count == 2
+    conn.get_object.assert_called_once_with('c', 'o')
+    assert (tmp_path / etag).read_bytes() == contents
+
+    # a changed object has a new ETag, so it is downloaded again
+    conn.head_object.return_value = {'etag': 'other'}
+    conn.get_object.return_value = ({'etag': 'other'}, b'new')
+    assert swift.get_object_cached('c', 'o', tmp_path) == b'new'
+    assert conn.get_object.call_count == 2
+    assert not (tmp_path / 'other').exists()
+
+
+def test_connection_shares_session(monkeypatch):
+    monkeypatch.setattr(swift, '_session', None)
+    monkeypatch.setattr(swift, '_connections', threading.local())
+    get_session = mock.Mock()
+    monkeypatch.setattr(swift.keystone, 'get_session', get_session)
+    monkeypatch.setattr(swift.swift_client, 'Connection', mock.Mock)
+
+    conns = [swift.connection(), swift.connection()]
+    thread = threading.Thread(target=lambda: conns.append(swift.connection()))
+    thread.start()
+    thread.join()
+    assert conns[0] is conns[1]
+    assert conns[0] is not conns[2]
+    get_session.assert_called_once_with()
@@ -7,7 +7,8 @@
 from keystoneauth1 import loading
 from keystoneauth1 import session as keystone_session
 import os
-import re
+
+from hivemind_contrib import hostlist
 
 CONFIGDIR = '~/.config/melbourne-tools/'
 
@@ -77,34 +78,6 @@ def try_assign(method, *args, **options):
 
 
 # Parse the nodelist using SLURM syntax
-def _parse_dash(range_str):
-    """Unpack the dash syntax into a set of number."""
-    hosts = range_str.split("-")
-    return (
-        range(int(hosts[0]), int(hosts[1]) + 1)
-        if len(hosts) > 1
-        else [range_str]
-    )
-
-
 def parse_nodes(nodes):
     """Parse list syntax (eg. qh2-rcc[01-10,13])."""
-    # Parse qh2-rcc5,qh2-rcc6,qh2-rcc7 syntax
-    nodes = re.split(r",\s*(?![^\[\]]*\])", nodes)
-
-    if len(nodes) > 1:
-        nodes = set(host for hosts in nodes for host in parse_nodes(hosts))
-    else:
-        # Parse qh2-rcc[112-114,115] syntax
-        match = re.search(r"(.*?)\[(.*?)\](.*)", nodes[0])
-        if match:
-            host_ranges = [
-                host
-                for hosts in parse_nodes(match.group(2))
-                for host in _parse_dash(hosts)
-            ]
-            nodes = set(
-                f"{match.group(1)}{host}{match.group(3)}"
-                for host in host_ranges
-            )
-    return nodes
+    return hostlist.HostList(nodes)
@@ -27,6 +27,8 @@ setup(
         'ssh2-python>=0.17.0',
         'humanize>=0.5.0',
         'tenacity>=5.0.0',
+        # for the shared hostlist parsing
+        'hivemind-contrib',
     ],
     entry_points={
         'console_scripts': [